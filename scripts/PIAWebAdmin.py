@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# PIA - STREAMLIT WEBUI - ADMIN
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+"""
+#####################################################
+##                                                 ##
+##         -- STREAMLIT PIA ADMIN PAGE --          ##
+##                                                 ##
+#####################################################
+"""
+
+import pandas as pd
+import streamlit as st
+from scripts.redirect import *
+from scripts.store import get_store
+from scripts.scheduler import get_scheduler
+
+# format number of bytes as MB string
+def format_mb(nr_bytes):
+    return str(round(nr_bytes / (1024 * 1024), 2)) + " MB"
+
+# main page
+def main():
+
+    title = st.title("PIAAdmin - Server Status")
+
+    text_1 = st.markdown("*Memory and disk usage of stored results of all sessions on this server.*")
+
+    store = get_store()
+
+    if st.button("Remove expired results!", help = "Remove all results that exceeded their lifetime from the result store."):
+        nr_expired = store.expire(force = True)
+        res_status = st.success("Removed " + str(nr_expired) + " expired results!")
+
+    usage = store.usage()
+
+    mkdown = "- **Memory Cache:** " + format_mb(usage["memory"]) + " of " + format_mb(usage["memory_budget"]) + "\n"
+    mkdown += "- **Memory per Session:** max. " + format_mb(usage["session_budget"]) + "\n"
+    mkdown += "- **On Disk:** " + format_mb(usage["disk"]) + "\n"
+    mkdown += "- **Stored Results:** " + str(usage["results"]) + "\n"
+    mkdown += "- **Sessions:** " + str(len(usage["sessions"])) + "\n"
+    summary = st.markdown(mkdown)
+
+    jobs = get_scheduler().status()
+
+    mkdown = "- **Running Jobs:** " + str(jobs["running"]) + " of " + str(jobs["max_concurrent"]) + "\n"
+    mkdown += "- **Running Large Jobs:** " + str(jobs["running_large"]) + " of " + str(jobs["max_large"]) + " (" + str(jobs["large_poses"]) + " poses or more)\n"
+    mkdown += "- **Large Jobs Deferred For At Most:** " + str(jobs["large_max_wait"]) + " s\n"
+    mkdown += "- **Waiting Jobs:** " + str(jobs["waiting"]) + "\n"
+    mkdown += "- **Maximum Job Size:** " + str(jobs["max_poses"]) + " poses\n"
+    scheduler_summary = st.markdown(mkdown)
+
+    memory_bar = st.progress(min(1.0, usage["memory"] / usage["memory_budget"]) if usage["memory_budget"] > 0 else 1.0)
+
+    if len(usage["sessions"]) > 0:
+        sub_title = st.subheader("Sessions")
+        sessions = pd.DataFrame([{"SESSION": (session[:8] if session is not None else "-") + (" (this session)" if session == get_session_id() else ""),
+                                  "MEMORY [MB]": round(values["memory"] / (1024 * 1024), 2),
+                                  "DISK [MB]": round(values["disk"] / (1024 * 1024), 2),
+                                  "RESULTS": values["results"]}
+                                 for session, values in usage["sessions"].items()])
+        sessions_table = st.dataframe(sessions.sort_values("MEMORY [MB]", ascending = False))
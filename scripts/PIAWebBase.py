@@ -13,49 +13,62 @@
 #####################################################
 """
 
+import io
 import os
-import json
 import shutil
 import random
 import streamlit as st
-import urllib.request as ur
 from datetime import datetime
 from scripts.redirect import *
+from scripts.store import get_store
+from scripts.jobs import run_job, job_key
+from scripts.scheduler import count_poses
+from scripts.uploads import SDF_TYPES, write_upload
+from scripts.downloads import download_structures
+from scripts.interactions import prepare_complexes
+from scripts.export import write_csv, write_json, write_parquet, interaction_table, columnar_export_available
+from scripts.charts import frequencies_to_json, frequency_chart
 from PIA.PIA import PIA
-from PIA.PIA import Preparation
+
+# server that PDB files are downloaded from, can be set via environment variable e.g. to a local mirror
+RCSB_DOWNLOAD_URL = os.environ.get("PIAWEB_RCSB_URL", "https://files.rcsb.org/download/")
 
 # return result as string in csv format
 def return_csv(PIAResult):
 
-    frequencies_csv = "Interaction,Frequency\n"
-    for key in PIAResult.i_frequencies:
-        frequencies_csv = frequencies_csv+ str(key) + "," + str(PIAResult.i_frequencies[key]) + "\n"
+    with io.StringIO() as f:
+        write_csv(PIAResult.i_frequencies, f)
+        frequencies_csv = f.getvalue()
 
     return frequencies_csv
 
-# workflow to extract interactions from a list of PDB codes
+# workflow to extract interactions from a list of PDB codes,
+# codes that can't be downloaded are skipped, with return_skipped = True they are returned along with the result
 #@st.cache
-def extract_codes(list_of_codes, normalize = True):
-
-    # create list of PDB links
-    filenames = [i + ".pdb" if i.split(".")[-1] != "pdb" else i for i in list_of_codes]
-    download_links = ["https://files.rcsb.org/download/" + i for i in filenames]
+def extract_codes(list_of_codes, normalize = True, return_skipped = False):
 
     # create unique file prefix
     output_name_prefix = datetime.now().strftime("%b-%d-%Y_%H-%M-%S") + "_" + str(random.randint(10000, 99999))
 
-    # download files
-    for i, link in enumerate(download_links):
-        ur.urlretrieve(link, output_name_prefix + filenames[i])
-        print("Downloaded ", filenames[i])
-
-    # extract interactions and frequencies
-    result = PIA([output_name_prefix + fn for fn in filenames], normalize = normalize)
-
-    # cleanup
-    for f in filenames:
-        os.remove(output_name_prefix + f)
-
+    # download compressed files
+    structures, skipped = download_structures(list_of_codes, output_name_prefix, RCSB_DOWNLOAD_URL)
+    if len(skipped) > 0:
+        print("Warning: Skipped " + str(len(skipped)) + " of " + str(len(list_of_codes)) + " PDB codes: " + ", ".join(skipped))
+
+    try:
+        if len(structures) == 0:
+            raise ValueError("None of the PDB codes could be downloaded!")
+        # extract interactions and frequencies
+        result = PIA(structures, normalize = normalize)
+        # names of the complexes in result.result for the exports
+        result.complexes = {f: os.path.basename(f)[len(output_name_prefix):-len(".pdb")] for f in structures}
+    finally:
+        # cleanup
+        for f in structures:
+            os.remove(f)
+
+    if return_skipped:
+        return result, skipped
     return result
 
 # workflow to extract interactions from protein-ligand complexes in SDF format
@@ -73,26 +86,37 @@ def extract_sdf(pdb_file, sdf_file, poses = "best", normalize = True):
     # write uploaded files to tmp directory
     with open(output_name_prefix + "_pdb_file.pdb", "wb") as f1:
         f1.write(pdb_file.getbuffer())
-    with open(output_name_prefix + "_sdf_file.sdf", "wb") as f2:
-        f2.write(sdf_file.getbuffer())
-
-    # extract interactions and frequencies
-    p = Preparation()
-    pdb = p.remove_ligands(output_name_prefix + "_pdb_file.pdb", output_name_prefix + "_pdb_file_cleaned.pdb")
-    ligands = p.get_ligands(output_name_prefix + "_sdf_file.sdf")
-    sdf_metainfo = p.get_sdf_metainfo(output_name_prefix + "_sdf_file.sdf")
-    ligand_names = sdf_metainfo["names"]
-    structures = p.add_ligands_multi(output_name_prefix + "_pdb_file_cleaned.pdb", structures_directory, ligands)
+    write_upload(sdf_file, output_name_prefix + "_sdf_file.sdf")
+
+    # extract interactions and frequencies, complexes are cropped to the binding pocket before PIA analyzes them
+    ligand_names, structures = prepare_complexes(output_name_prefix + "_pdb_file.pdb", output_name_prefix + "_sdf_file.sdf", structures_directory)
     result = PIA(structures, ligand_names = ligand_names, poses = poses, path = "current", normalize = normalize)
+    # names of the complexes in result.result for the exports
+    result.complexes = {structure: os.path.basename(structure) for structure in structures}
 
     # cleanup
     shutil.rmtree(structures_directory)
     os.remove(output_name_prefix + "_pdb_file.pdb")
-    os.remove(output_name_prefix + "_pdb_file_cleaned.pdb")
+    os.remove(output_name_prefix + "_pdb_file.pdb_cleaned.pdb")
     os.remove(output_name_prefix + "_sdf_file.sdf")
 
     return result
 
+# store all downloads and the chart data of a result and return their result ids
+def store_result(result, session = None):
+
+    store = get_store()
+
+    result_ids = {}
+    result_ids["csv_file"] = store.put_stream(lambda f: write_csv(result.i_frequencies, f), kind = "text", session = session)
+    result_ids["json_file"] = store.put_stream(lambda f: write_json(result.result, f), kind = "text", session = session)
+    if columnar_export_available():
+        result_ids["parquet_file"] = store.put_stream(lambda f: write_parquet(interaction_table(result.result, result.complexes), f), binary = True, session = session)
+    # the chart is rendered by the browser, only the frequencies are stored
+    result_ids["chart"] = store.put_text(frequencies_to_json(result.i_frequencies), session = session)
+
+    return result_ids
+
 # main page
 def main():
 
@@ -122,8 +146,8 @@ def main():
                                     )
 
         sdf_file = st.file_uploader("Upload docked ligand coordinates in SDF format:",
-                                    type = ["sdf"],
-                                    help = "The coordinates of the docked ligands in SDF format. Not all SD files might be supported. Supported software: GOLD."
+                                    type = SDF_TYPES,
+                                    help = "The coordinates of the docked ligands in SDF format. Not all SD files might be supported. Supported software: GOLD. Large files can be uploaded compressed as .sdf.gz or .zip."
                                     )
 
         poses = st.selectbox("Poses to analyze:",
@@ -133,7 +157,10 @@ def main():
 
     col_1b, col_2b = st.columns(2)
 
-    result = None
+    store = get_store()
+    session_id = get_session_id()
+
+    result_ids = None
 
     with col_1b:
         if st.button("Run!", help = "Run analysis with PDB codes as input."):
@@ -141,7 +168,9 @@ def main():
             with st.expander("Show logging info:"):
                 with st_stdout("info"):
                     try:
-                        result = extract_codes(pdb_codes_processed)
+                        result_ids = run_job(job_key("extract_codes", pdb_codes_processed, True), session_id, lambda: len(pdb_codes_processed),
+                                             lambda: store_result(extract_codes(pdb_codes_processed), session_id),
+                                             store.exists_all, on_wait = st_queue_status())
                         status_1 = 0
                     except Exception as e:
                         this_e = st.exception(e)
@@ -157,7 +186,9 @@ def main():
                 with st_stdout("info"):
                     if pdb_file != None and sdf_file != None:
                         try:
-                            result = extract_sdf(pdb_file, sdf_file, poses.lower())
+                            result_ids = run_job(job_key("extract_sdf", pdb_file, sdf_file, poses.lower(), True), session_id, lambda: count_poses(sdf_file),
+                                                 lambda: store_result(extract_sdf(pdb_file, sdf_file, poses.lower()), session_id),
+                                                 store.exists_all, on_wait = st_queue_status())
                             status_2 = 0
                         except Exception as e:
                             this_e = st.exception(e)
@@ -170,27 +201,39 @@ def main():
             else:
                 res_status_2 = st.error("Analysis stopped prematurely! See log for more information!")
 
-    if result != None:
-        st.session_state["csv_file"] = return_csv(result)
-        st.session_state["json_file"] = json.dumps(result.result)
-        st.session_state["plot"] = result.plot("Results of PIA - Workflow I")
+    if result_ids != None:
+        for key in result_ids:
+            st.session_state[key] = result_ids[key]
+
+    # drop results that expired in the store
+    for key in ["csv_file", "json_file", "parquet_file", "chart"]:
+        if key in st.session_state and not store.exists(st.session_state[key]):
+            del st.session_state[key]
 
-    if "plot" in st.session_state:
-        plot = st.pyplot(st.session_state["plot"])
+    if "chart" in st.session_state:
+        chart_data, chart_spec = frequency_chart(store.get_text(st.session_state["chart"]), "Results of PIA - Workflow I")
+        plot = st.vega_lite_chart(chart_data, chart_spec, use_container_width = True)
 
     if "csv_file" in st.session_state or "json_file" in st.session_state:
         with st.expander("Download Results:"):
             if "csv_file" in st.session_state:
                 csv = st.download_button(label = "Download CSV!",
-                                         data = st.session_state["csv_file"],
+                                         data = store.get_bytes(st.session_state["csv_file"]),
                                          file_name = "result.csv",
                                          mime = "text/csv",
                                          help = "Download interactions and frequencies in CSV file format."
                                          )
             if "json_file" in st.session_state:
                 jsf = st.download_button(label = "Download JSON!",
-                                         data = st.session_state["json_file"],
+                                         data = store.get_bytes(st.session_state["json_file"]),
                                          file_name = "result.json",
                                          mime = "text/json",
                                          help = "Download interactions, frequencies an structure information in JSON file format."
                                          )
+            if "parquet_file" in st.session_state:
+                pqf = st.download_button(label = "Download Parquet!",
+                                         data = store.get_bytes(st.session_state["parquet_file"]),
+                                         file_name = "result.parquet",
+                                         mime = "application/octet-stream",
+                                         help = "Download interactions of every complex as a table in Parquet file format."
+                                         )
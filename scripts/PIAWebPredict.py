@@ -17,9 +17,16 @@ import os
 import math
 import shutil
 import random
+import pandas as pd
 import streamlit as st
 from datetime import datetime
 from scripts.redirect import *
+from scripts.store import get_store
+from scripts.jobs import run_job, job_key
+from scripts.scheduler import count_poses
+from scripts.uploads import SDF_TYPES, upload_name, write_upload
+from scripts.interactions import extract_profiles
+from scripts.models import BinaryModel, is_binary_model, encode_model
 from PIA.PIAModel import PIAModel
 
 # color encoding for pandas dataframes
@@ -33,12 +40,105 @@ def color_code(value):
 
     return color
 
+# vectorized color encoding of a prediction column, color_code is only evaluated once per distinct value
+def color_predictions(column):
+    return column.map({value: color_code(value) for value in column.unique()})
+
+# prediction counts of a result table without building a styled dataframe
+def summarize_predictions(dataframe):
+    prediction_columns = [c for c in dataframe.columns if str(c).endswith("PREDICTION")]
+    return {c: dataframe[c].value_counts().to_dict() for c in prediction_columns}
+
+# filter, sort and page a result table on the server, only the returned page is sent to the browser
+def filter_results(dataframe, search = "", prediction = "all", sort_by = None, ascending = True, page = 1, page_size = 50):
+    prediction_columns = [c for c in dataframe.columns if str(c).endswith("PREDICTION")]
+    mask = pd.Series(True, index = dataframe.index)
+    if search != "":
+        text_columns = [c for c in dataframe.columns if not pd.api.types.is_numeric_dtype(dataframe[c]) and c not in prediction_columns]
+        search_mask = pd.Series(False, index = dataframe.index)
+        for c in text_columns:
+            search_mask |= dataframe[c].astype(str).str.contains(search, case = False, regex = False)
+        mask &= search_mask
+    if prediction != "all" and len(prediction_columns) > 0:
+        prediction_mask = pd.Series(False, index = dataframe.index)
+        for c in prediction_columns:
+            prediction_mask |= dataframe[c] == prediction
+        mask &= prediction_mask
+    filtered = dataframe[mask]
+    if sort_by is not None:
+        filtered = filtered.sort_values(sort_by, ascending = ascending, kind = "mergesort")
+    nr_pages = max(1, math.ceil(len(filtered) / page_size))
+    page = min(max(1, page), nr_pages)
+    return filtered.iloc[(page - 1) * page_size:page * page_size], len(filtered), nr_pages
+
+# result viewer with summary counts, server side filtering, sorting and paging
+def show_results(dataframe, key):
+
+    counts = summarize_predictions(dataframe)
+    mkdown = "- **Complexes:** " + str(len(dataframe)) + "\n"
+    for column in counts:
+        label = "" if column == "PREDICTION" else " (" + column.replace("PREDICTION", "").strip() + ")"
+        mkdown += "- **Active" + label + ":** " + str(counts[column].get("active", 0)) + "\n"
+        mkdown += "- **Inactive" + label + ":** " + str(counts[column].get("inactive", 0)) + "\n"
+    summary = st.markdown(mkdown)
+
+    col_1, col_2 = st.columns(2)
+
+    with col_1:
+        search = st.text_input(label = "Search:",
+                               value = "",
+                               help = "Only show complexes that contain the given text.",
+                               key = key + "_search"
+                               )
+        sort_by = st.selectbox(label = "Sort by:",
+                               options = ["-"] + list(dataframe.columns),
+                               help = "Column that the results are sorted by.",
+                               key = key + "_sort_by"
+                               )
+        page_size = st.selectbox(label = "Rows per page:",
+                                 options = [25, 50, 100, 250],
+                                 index = 1,
+                                 help = "Number of complexes that are shown per page.",
+                                 key = key + "_page_size"
+                                 )
+
+    with col_2:
+        prediction = st.selectbox(label = "Show:",
+                                  options = ["all", "active", "inactive"],
+                                  help = "Only show complexes with the given prediction.",
+                                  key = key + "_prediction"
+                                  )
+        order = st.selectbox(label = "Order:",
+                             options = ["Ascending", "Descending"],
+                             help = "Sort order of the results.",
+                             key = key + "_order"
+                             )
+        page = st.number_input(label = "Page:",
+                               min_value = 1,
+                               value = 1,
+                               step = 1,
+                               help = "Page of the results that is shown.",
+                               key = key + "_page"
+                               )
+
+    page_frame, nr_results, nr_pages = filter_results(dataframe,
+                                                      search = search,
+                                                      prediction = prediction,
+                                                      sort_by = None if sort_by == "-" else sort_by,
+                                                      ascending = order == "Ascending",
+                                                      page = int(page),
+                                                      page_size = page_size)
+
+    prediction_columns = [c for c in page_frame.columns if str(c).endswith("PREDICTION")]
+    res_table = st.dataframe(page_frame.style.apply(color_predictions, subset = prediction_columns))
+    res_caption = st.caption("Page " + str(min(int(page), nr_pages)) + " of " + str(nr_pages) + " - " + str(nr_results) + " matching complexes.")
+
 # workflow to predict a single protein-ligand complex
 def predict_pdb(model_info, pdb_file, cutoff = None, name = None):
 
     # check if model or interactions are given
     if isinstance(model_info, str):
-        model = PIAModel(filename = model_info)
+        model = read_model(model_info)
     else:
         if cutoff is not None:
             model = PIAModel(positives = model_info, strategy = "+", cutoff = cutoff)
@@ -53,7 +153,7 @@ def predict_sdf(model_info, pdb_file, sdf_file, cutoff = None, tmp_dir_name = "p
 
     # check if model or interactions are given
     if isinstance(model_info, str):
-        model = PIAModel(filename = model_info)
+        model = read_model(model_info)
     else:
         if cutoff is not None:
             model = PIAModel(positives = model_info, strategy = "+", cutoff = cutoff)
@@ -63,6 +163,77 @@ def predict_sdf(model_info, pdb_file, sdf_file, cutoff = None, tmp_dir_name = "p
     # return prediction
     return model.predict_sdf(pdb_file, sdf_file, save_csv = False, tmp_dir_name = tmp_dir_name)
 
+# write an uploaded model, json and binary models are written as they are
+def write_model(model_file, filename):
+    with open(filename, "wb") as f:
+        f.write(model_file.getbuffer())
+    return filename
+
+# read a model file as PIAModel, binary models are built from their fields instead of being converted to json and
+# parsed again, PIAModel can only be created from a json file or from positives so the other fields are set afterwards
+def read_model(filename):
+
+    if not is_binary_model(filename):
+        return PIAModel(filename = filename)
+
+    binary = BinaryModel(filename)
+    try:
+        model = PIAModel(positives = binary.positives, strategy = "+", cutoff = binary.cutoff)
+        model.negatives = binary.negatives
+        model.strategy = binary.strategy
+        model.statistics = binary.statistics
+    finally:
+        binary.close()
+
+    return model
+
+# load a model for scoring, binary models are memory-mapped, json models are read with PIAModel and interned
+def load_model(filename):
+
+    if is_binary_model(filename):
+        return BinaryModel(filename)
+
+    model = PIAModel(filename = filename)
+    return BinaryModel(data = encode_model({"positives": model.positives, "negatives": model.negatives, "strategy": model.strategy,
+                                            "cutoff": model.cutoff, "statistics": model.statistics}))
+
+# predict extracted interaction profiles with several models, returns one score and prediction column per model
+def predict_profiles(models, extracted):
+
+    columns = {"NAME": extracted["names"] if len(extracted["names"]) == len(extracted["profiles"]) else extracted["structures"]}
+    for model_name, model in models.items():
+        scores = [model.score(profile) for profile in extracted["profiles"]]
+        columns[model_name + " SCORE"] = scores
+        columns[model_name + " PREDICTION"] = ["active" if score >= model.cutoff else "inactive" for score in scores]
+
+    return pd.DataFrame(columns)
+
+# workflow to predict multiple protein-ligand complexes with multiple models,
+# interactions are extracted once and shared by all models
+def predict_sdf_multi(model_files, pdb_file, sdf_file, model_names = None, tmp_dir_name = "piamodel_structures_tmp"):
+
+    if model_names is None:
+        model_names = [os.path.basename(f).split(".piam")[0] for f in model_files]
+
+    # load all models first so invalid models fail before the expensive extraction
+    models = {}
+    try:
+        for model_name, model_file in zip(model_names, model_files):
+            unique_name = model_name
+            i = 2
+            while unique_name in models:
+                unique_name = model_name + "_" + str(i)
+                i += 1
+            models[unique_name] = load_model(model_file)
+
+        extracted = extract_profiles(pdb_file, sdf_file, tmp_dir_name = tmp_dir_name)
+        dataframe = predict_profiles(models, extracted)
+    finally:
+        for model in models.values():
+            model.close()
+
+    return {"dataframe": dataframe}
+
 # main page
 def main():
 
@@ -74,12 +245,15 @@ def main():
     text_1_2 = st.markdown(text_1_2_txt)
 
     piamodel = st.file_uploader("Upload a model:",
-                                type = ["piam"],
+                                type = ["piam", "piamb"],
                                 help = "The PIAModel that should be used for prediction."
                                 )
 
     col_1_1, col_1_2 = st.columns(2)
 
+    store = get_store()
+    session_id = get_session_id()
+
     result_1 = None
 
     with col_1_1:
@@ -101,13 +275,14 @@ def main():
                             #write files
                             with open(output_name_prefix + pdb_file_1_1.name, "wb") as f1:
                                 f1.write(pdb_file_1_1.getbuffer())
-                            with open(output_name_prefix + piamodel.name, "wb") as f2:
-                                f2.write(piamodel.getbuffer())
+                            write_model(piamodel, output_name_prefix + "_model.piam")
                             # get prediction
-                            result_1 = predict_pdb(output_name_prefix + piamodel.name, output_name_prefix + pdb_file_1_1.name, name = pdb_file_1_1.name)
+                            result_1 = run_job(job_key("predict_pdb", piamodel, pdb_file_1_1, pdb_file_1_1.name), session_id, lambda: 1,
+                                               lambda: store.put_table(predict_pdb(output_name_prefix + "_model.piam", output_name_prefix + pdb_file_1_1.name, name = pdb_file_1_1.name)["dataframe"], session = session_id),
+                                               store.exists, on_wait = st_queue_status())
                             # cleanup
                             os.remove(output_name_prefix + pdb_file_1_1.name)
-                            os.remove(output_name_prefix + piamodel.name)
+                            os.remove(output_name_prefix + "_model.piam")
                             # set status
                             status_1 = 0
                         except Exception as e:
@@ -131,8 +306,8 @@ def main():
                                         )
 
         sdf_file_1_2 = st.file_uploader("Upload docked ligand coordinates in SDF format:",
-                                        type = ["sdf"],
-                                        help = "The coordinates of the docked ligands in SDF format. Not all SD files might be supported. Supported software: GOLD.",
+                                        type = SDF_TYPES,
+                                        help = "The coordinates of the docked ligands in SDF format. Not all SD files might be supported. Supported software: GOLD. Large files can be uploaded compressed as .sdf.gz or .zip.",
                                         key = "sdf_file_1_2"
                                         )
 
@@ -146,16 +321,16 @@ def main():
                             #write files
                             with open(output_name_prefix + pdb_file_1_2.name, "wb") as f1:
                                 f1.write(pdb_file_1_2.getbuffer())
-                            with open(output_name_prefix + sdf_file_1_2.name, "wb") as f1:
-                                f1.write(sdf_file_1_2.getbuffer())
-                            with open(output_name_prefix + piamodel.name, "wb") as f3:
-                                f3.write(piamodel.getbuffer())
+                            write_upload(sdf_file_1_2, output_name_prefix + upload_name(sdf_file_1_2))
+                            write_model(piamodel, output_name_prefix + "_model.piam")
                             # get prediction
-                            result_1 = predict_sdf(output_name_prefix + piamodel.name, output_name_prefix + pdb_file_1_2.name, output_name_prefix + sdf_file_1_2.name, tmp_dir_name = output_name_prefix + "_structures")
+                            result_1 = run_job(job_key("predict_sdf", piamodel, pdb_file_1_2, sdf_file_1_2), session_id, lambda: count_poses(sdf_file_1_2),
+                                               lambda: store.put_table(predict_sdf(output_name_prefix + "_model.piam", output_name_prefix + pdb_file_1_2.name, output_name_prefix + upload_name(sdf_file_1_2), tmp_dir_name = output_name_prefix + "_structures")["dataframe"], session = session_id),
+                                               store.exists, on_wait = st_queue_status())
                             # cleanup
                             os.remove(output_name_prefix + pdb_file_1_2.name)
-                            os.remove(output_name_prefix + sdf_file_1_2.name)
-                            os.remove(output_name_prefix + piamodel.name)
+                            os.remove(output_name_prefix + upload_name(sdf_file_1_2))
+                            os.remove(output_name_prefix + "_model.piam")
                             # set status
                             status_1 = 0
                         except Exception as e:
@@ -175,11 +350,97 @@ def main():
                 res_1_status = st.error("Prediction failed! See log for more information!")
 
     if result_1 != None:
-        st.session_state["prediction_1"] = result_1["dataframe"]
+        st.session_state["prediction_1"] = result_1
+
+    if "prediction_1" in st.session_state and not store.exists(st.session_state["prediction_1"]):
+        del st.session_state["prediction_1"]
 
     if "prediction_1" in st.session_state:
         sub_title_1 = st.subheader("Results")
-        res_table_1 = st.dataframe(st.session_state["prediction_1"].style.applymap(color_code, subset = "PREDICTION"))
+        table_1 = store.get_table(st.session_state["prediction_1"])
+        if table_1 is not None:
+            res_table_1 = show_results(table_1, key = "prediction_1")
+
+    sub_title_3 = st.subheader("Multiple Models")
+
+    text_3_1 = st.markdown("Screen docked ligands against several models at once. Interactions are only extracted once and then scored by every model.")
+
+    piamodels = st.file_uploader("Upload models:",
+                                 type = ["piam", "piamb"],
+                                 accept_multiple_files = True,
+                                 help = "The PIAModels that should be used for prediction, all models have to be trained for the given host structure.",
+                                 key = "piamodels_3"
+                                 )
+
+    col_3_1, col_3_2 = st.columns(2)
+
+    with col_3_1:
+        pdb_file_3 = st.file_uploader("Upload the PDB host structure:",
+                                      type = ["pdb"],
+                                      help = "The target host structure that was used for docking of the ligands in PDB file format.",
+                                      key = "pdb_file_3"
+                                      )
+
+    with col_3_2:
+        sdf_file_3 = st.file_uploader("Upload docked ligand coordinates in SDF format:",
+                                      type = SDF_TYPES,
+                                      help = "The coordinates of the docked ligands in SDF format. Not all SD files might be supported. Supported software: GOLD. Large files can be uploaded compressed as .sdf.gz or .zip.",
+                                      key = "sdf_file_3"
+                                      )
+
+    result_3 = None
+
+    if st.button("Predict!", help = "Predict the activity of the given docked protein-ligand complexes with all supplied models."):
+        with st.expander("Show logging info:"):
+            with st_stdout("info"):
+                if len(piamodels) > 0 and pdb_file_3 != None and sdf_file_3 != None:
+                    # create unique file prefix
+                    output_name_prefix = datetime.now().strftime("%b-%d-%Y_%H-%M-%S") + "_" + str(random.randint(10000, 99999))
+                    model_files = []
+                    try:
+                        #write files
+                        with open(output_name_prefix + pdb_file_3.name, "wb") as f1:
+                            f1.write(pdb_file_3.getbuffer())
+                        write_upload(sdf_file_3, output_name_prefix + upload_name(sdf_file_3))
+                        for i, piamodel_i in enumerate(piamodels):
+                            model_files.append(output_name_prefix + "_" + str(i) + "_" + piamodel_i.name)
+                            with open(model_files[-1], "wb") as f3:
+                                f3.write(piamodel_i.getbuffer())
+                        # get prediction
+                        model_names = [m.name.split(".piam")[0] for m in piamodels]
+                        result_3 = run_job(job_key("predict_sdf_multi", pdb_file_3, sdf_file_3, model_names, *piamodels), session_id, lambda: count_poses(sdf_file_3),
+                                           lambda: store.put_table(predict_sdf_multi(model_files, output_name_prefix + pdb_file_3.name, output_name_prefix + upload_name(sdf_file_3),
+                                                                                     model_names = model_names, tmp_dir_name = output_name_prefix + "_structures")["dataframe"], session = session_id),
+                                           store.exists, on_wait = st_queue_status())
+                        # set status
+                        status_3 = 0
+                    except Exception as e:
+                        this_e = st.exception(e)
+                        status_3 = 1
+                    finally:
+                        # cleanup
+                        for f in [output_name_prefix + pdb_file_3.name, output_name_prefix + upload_name(sdf_file_3)] + model_files:
+                            if os.path.isfile(f):
+                                os.remove(f)
+                else:
+                    status_3 = 1
+                    no_file = st.error("Error: At least one model, PDB host structure and ligands in SDF format have to be provided for prediction!")
+        if status_3 == 0:
+            res_3_status = st.success("Prediction finished successfully!")
+        else:
+            res_3_status = st.error("Prediction failed! See log for more information!")
+
+    if result_3 != None:
+        st.session_state["prediction_3"] = result_3
+
+    if "prediction_3" in st.session_state and not store.exists(st.session_state["prediction_3"]):
+        del st.session_state["prediction_3"]
+
+    if "prediction_3" in st.session_state:
+        sub_title_3_1 = st.subheader("Results")
+        table_3 = store.get_table(st.session_state["prediction_3"])
+        if table_3 is not None:
+            res_table_3 = show_results(table_3, key = "prediction_3")
 
     title_2 = st.title("PIAPredict - Workflow IV")
 
@@ -234,7 +495,10 @@ def main():
                             except:
                                 cutoff_2_1 = None
                             # get prediction
-                            result_2 = predict_pdb([i.strip() for i in interactions.split(",")], output_name_prefix + pdb_file_2_1.name, cutoff = cutoff_2_1, name = pdb_file_2_1.name)
+                            interactions_2_1 = [i.strip() for i in interactions.split(",")]
+                            result_2 = run_job(job_key("predict_pdb", interactions_2_1, cutoff_2_1, pdb_file_2_1, pdb_file_2_1.name), session_id, lambda: 1,
+                                               lambda: store.put_table(predict_pdb(interactions_2_1, output_name_prefix + pdb_file_2_1.name, cutoff = cutoff_2_1, name = pdb_file_2_1.name)["dataframe"], session = session_id),
+                                               store.exists, on_wait = st_queue_status())
                             # cleanup
                             os.remove(output_name_prefix + pdb_file_2_1.name)
                             # set status
@@ -260,8 +524,8 @@ def main():
                                         )
 
         sdf_file_2_2 = st.file_uploader("Upload docked ligand coordinates in SDF format:",
-                                        type = ["sdf"],
-                                        help = "The coordinates of the docked ligands in SDF format. Not all SD files might be supported. Supported software: GOLD.",
+                                        type = SDF_TYPES,
+                                        help = "The coordinates of the docked ligands in SDF format. Not all SD files might be supported. Supported software: GOLD. Large files can be uploaded compressed as .sdf.gz or .zip.",
                                         key = "sdf_file_2_2"
                                         )
 
@@ -275,18 +539,20 @@ def main():
                             #write files
                             with open(output_name_prefix + pdb_file_2_2.name, "wb") as f1:
                                 f1.write(pdb_file_2_2.getbuffer())
-                            with open(output_name_prefix + sdf_file_2_2.name, "wb") as f1:
-                                f1.write(sdf_file_2_2.getbuffer())
+                            write_upload(sdf_file_2_2, output_name_prefix + upload_name(sdf_file_2_2))
                             #process cutoff
                             try:
                                 cutoff_2_2 = int(cutoff)
                             except:
                                 cutoff_2_2 = None
                             # get prediction
-                            result_2 = predict_sdf([i.strip() for i in interactions.split(",")], output_name_prefix + pdb_file_2_2.name, output_name_prefix + sdf_file_2_2.name, cutoff = cutoff_2_2, tmp_dir_name = output_name_prefix + "_structures")
+                            interactions_2_2 = [i.strip() for i in interactions.split(",")]
+                            result_2 = run_job(job_key("predict_sdf", interactions_2_2, cutoff_2_2, pdb_file_2_2, sdf_file_2_2), session_id, lambda: count_poses(sdf_file_2_2),
+                                               lambda: store.put_table(predict_sdf(interactions_2_2, output_name_prefix + pdb_file_2_2.name, output_name_prefix + upload_name(sdf_file_2_2), cutoff = cutoff_2_2, tmp_dir_name = output_name_prefix + "_structures")["dataframe"], session = session_id),
+                                               store.exists, on_wait = st_queue_status())
                             # cleanup
                             os.remove(output_name_prefix + pdb_file_2_2.name)
-                            os.remove(output_name_prefix + sdf_file_2_2.name)
+                            os.remove(output_name_prefix + upload_name(sdf_file_2_2))
                             # set status
                             status_2 = 0
                         except Exception as e:
@@ -306,8 +572,13 @@ def main():
                 res_2_status = st.error("Prediction failed! See log for more information!")
 
     if result_2 != None:
-        st.session_state["prediction_2"] = result_2["dataframe"]
+        st.session_state["prediction_2"] = result_2
+
+    if "prediction_2" in st.session_state and not store.exists(st.session_state["prediction_2"]):
+        del st.session_state["prediction_2"]
 
     if "prediction_2" in st.session_state:
         sub_title_2 = st.subheader("Results")
-        res_table_2 = st.dataframe(st.session_state["prediction_2"].style.applymap(color_code, subset = "PREDICTION"))
+        table_2 = store.get_table(st.session_state["prediction_2"])
+        if table_2 is not None:
+            res_table_2 = show_results(table_2, key = "prediction_2")
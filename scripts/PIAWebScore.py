@@ -18,12 +18,24 @@ import json
 import shutil
 import random
 import streamlit as st
+import matplotlib.pyplot as plt
 from zipfile import ZipFile
 from datetime import datetime
 from scripts.redirect import *
+from scripts.store import get_store
+from scripts.jobs import run_job, job_key
+from scripts.scheduler import count_poses
+from scripts.uploads import SDF_TYPES, write_upload
+from scripts.sweep import sweep
+from scripts.models import convert_model, json_to_binary
+from scripts.charts import roc_to_dict, roc_chart
 from PIA.PIAScore import *
 from PIA.PIAModel import PIAModel
 
+# session state keys of results that are kept in the result store
+STORED_KEYS = ["result_zip", "model_p", "model_pp", "model_pm", "model_ppmm",
+               "model_p_binary", "model_pp_binary", "model_pm_binary", "model_ppmm_binary"]
+
 # return model configuration as string in json format
 def export_model(model, strat = "+"):
 
@@ -51,11 +63,9 @@ def score(pdb_file, sdf_file_1, sdf_file_2 = None, poses = "best", test_size = 0
     # write uploaded files to tmp directory
     with open(output_name_prefix + "_pdb_file.pdb", "wb") as f1:
         f1.write(pdb_file.getbuffer())
-    with open(output_name_prefix + "_sdf_file_1.sdf", "wb") as f2:
-        f2.write(sdf_file_1.getbuffer())
+    write_upload(sdf_file_1, output_name_prefix + "_sdf_file_1.sdf")
     if sdf_file_2 != None:
-        with open(output_name_prefix + "_sdf_file_2.sdf", "wb") as f2:
-            f2.write(sdf_file_2.getbuffer())
+        write_upload(sdf_file_2, output_name_prefix + "_sdf_file_2.sdf")
         this_sdf_file_2 = output_name_prefix + "_sdf_file_2.sdf"
     else:
         this_sdf_file_2 = None
@@ -164,12 +174,21 @@ def score(pdb_file, sdf_file_1, sdf_file_2 = None, poses = "best", test_size = 0
     filelist.append(output_name_prefix + "_ppmm.piam")
     model.change_strategy("best")
 
+    # binary versions of all models
+    for suffix in ["_best", "_p", "_pp", "_pm", "_ppmm"]:
+        filelist.append(convert_model(output_name_prefix + suffix + ".piam", output_name_prefix + suffix + ".piamb"))
+
     # generate zip archive
     with ZipFile(output_name_prefix + "_result.zip", "w") as zf:
         for f in filelist:
             zf.write(f)
         zf.close()
 
+    # release ROC and confusion matrix figures, they are only needed in the zip archive and the page renders the curves client-side
+    for fig in [p_1, p_2, p_3, p_4, p_5, p_6, p_7, p_8, p_9, p_10, p_11, p_12,
+                cm_1, cm_2, cm_3, cm_4, cm_5, cm_6, cm_7, cm_8, cm_9, cm_10, cm_11, cm_12]:
+        plt.close(fig)
+
     # cleanup
     for f in filelist:
         os.remove(f)
@@ -184,14 +203,65 @@ def score(pdb_file, sdf_file_1, sdf_file_2 = None, poses = "best", test_size = 0
               "model_pp": export_model(model, strat = "++"),
               "model_pm": export_model(model, strat = "+-"),
               "model_ppmm": export_model(model, strat = "++--"),
-              "roc_plot_p": p_9,
-              "roc_plot_pp": p_10,
-              "roc_plot_pm": p_11,
-              "roc_plot_ppmm": p_12,
+              "roc_p": roc_to_dict(train_results["TEST"]["+"]["ROC"]["fpr"], train_results["TEST"]["+"]["ROC"]["tpr"]),
+              "roc_pp": roc_to_dict(train_results["TEST"]["++"]["ROC"]["fpr"], train_results["TEST"]["++"]["ROC"]["tpr"]),
+              "roc_pm": roc_to_dict(train_results["TEST"]["+-"]["ROC"]["fpr"], train_results["TEST"]["+-"]["ROC"]["tpr"]),
+              "roc_ppmm": roc_to_dict(train_results["TEST"]["++--"]["ROC"]["fpr"], train_results["TEST"]["++--"]["ROC"]["tpr"]),
               "zipfile": output_name_prefix + "_result.zip"}
 
     return result
 
+# store models and the zip archive of a scoring result, returns result ids and the small results
+def store_result(result, session = None):
+
+    store = get_store()
+
+    # roc curves are small and rendered by the browser, they are kept directly in the session like the statistics
+    result_ids = {"model_statistics": result["statistics"], "result_zip_name": result["zipfile"],
+                  "roc_p": result["roc_p"], "roc_pp": result["roc_pp"], "roc_pm": result["roc_pm"], "roc_ppmm": result["roc_ppmm"]}
+    result_ids["result_zip"] = store.put_file(result["zipfile"], kind = "zip", session = session)
+    result_ids["model_p"] = store.put_text(result["model_p"], session = session)
+    result_ids["model_pp"] = store.put_text(result["model_pp"], session = session)
+    result_ids["model_pm"] = store.put_text(result["model_pm"], session = session)
+    result_ids["model_ppmm"] = store.put_text(result["model_ppmm"], session = session)
+    result_ids["model_p_binary"] = store.put_bytes(json_to_binary(result["model_p"]), kind = "piamb", session = session)
+    result_ids["model_pp_binary"] = store.put_bytes(json_to_binary(result["model_pp"]), kind = "piamb", session = session)
+    result_ids["model_pm_binary"] = store.put_bytes(json_to_binary(result["model_pm"]), kind = "piamb", session = session)
+    result_ids["model_ppmm_binary"] = store.put_bytes(json_to_binary(result["model_ppmm"]), kind = "piamb", session = session)
+
+    return result_ids
+
+# sweep over split sizes, PIA models are trained in parallel
+def score_sweep(pdb_file, sdf_file_1, sdf_file_2 = None, poses = "best", test_sizes = [0.3], val_sizes = [0.3], repeats = 10,
+                labels_by = "name", condition_operator = ">=", condition_value = 1000):
+
+    # output file prefix
+    output_name_prefix = sdf_file_1.name.split(".sdf")[0] + datetime.now().strftime("%b-%d-%Y_%H-%M-%S") + "_" + str(random.randint(10000, 99999))
+
+    # write uploaded files to tmp directory
+    with open(output_name_prefix + "_pdb_file.pdb", "wb") as f1:
+        f1.write(pdb_file.getbuffer())
+    write_upload(sdf_file_1, output_name_prefix + "_sdf_file_1.sdf")
+    if sdf_file_2 != None:
+        write_upload(sdf_file_2, output_name_prefix + "_sdf_file_2.sdf")
+        this_sdf_file_2 = output_name_prefix + "_sdf_file_2.sdf"
+    else:
+        this_sdf_file_2 = None
+
+    try:
+        result = sweep(output_name_prefix + "_pdb_file.pdb", output_name_prefix + "_sdf_file_1.sdf", this_sdf_file_2,
+                       poses = poses, labels_by = labels_by, condition_operator = condition_operator, condition_value = float(condition_value),
+                       test_sizes = test_sizes, val_sizes = val_sizes, repeats = repeats,
+                       tmp_prefix = output_name_prefix)
+    finally:
+        # cleanup
+        os.remove(output_name_prefix + "_pdb_file.pdb")
+        os.remove(output_name_prefix + "_sdf_file_1.sdf")
+        if sdf_file_2 != None:
+            os.remove(output_name_prefix + "_sdf_file_2.sdf")
+
+    return result
+
 # main page
 def main():
 
@@ -206,13 +276,13 @@ def main():
                                 )
 
     sdf_file_1 = st.file_uploader("Upload docked ligand coordinates in SDF format:",
-                                  type = ["sdf"],
-                                  help = "The coordinates of the docked ligands in SDF format. Not all SD files might be supported. Supported software: GOLD."
+                                  type = SDF_TYPES,
+                                  help = "The coordinates of the docked ligands in SDF format. Not all SD files might be supported. Supported software: GOLD. Large files can be uploaded compressed as .sdf.gz or .zip."
                                   )
 
     sdf_file_2 = st.file_uploader("[Optional] Upload additional docked ligand coordinates in SDF format:",
-                                  type = ["sdf"],
-                                  help = "The coordinates of the docked ligands in SDF format. Not all SD files might be supported. Supported software: GOLD."
+                                  type = SDF_TYPES,
+                                  help = "The coordinates of the docked ligands in SDF format. Not all SD files might be supported. Supported software: GOLD. Large files can be uploaded compressed as .sdf.gz or .zip."
                                   )
 
     mode_help_str = "Select a labelling criterion e.g. if 'Ligand name' is selected ligands that contain the phrase 'inactive' or 'decoy' in their name will be labelled "
@@ -244,14 +314,20 @@ def main():
                                         help = condition_value_help_str
                                         )
 
-    result = None
+    store = get_store()
+    session_id = get_session_id()
+
+    result_ids = None
 
     if st.button("Run!", help = "Train and evaluate model based on the given input."):
         with st.expander("Show logging info:"):
             with st_stdout("info"):
                 if pdb_file != None and sdf_file_1 != None:
                     try:
-                        result = score(pdb_file, sdf_file_1, sdf_file_2, labels_by = mode["value"], condition_operator = condition_operator, condition_value = condition_value)
+                        result_ids = run_job(job_key("score", pdb_file, sdf_file_1, sdf_file_2, "best", 0.3, 0.3, mode["value"], condition_operator, condition_value),
+                                             session_id, lambda: count_poses(sdf_file_1) + count_poses(sdf_file_2),
+                                             lambda: store_result(score(pdb_file, sdf_file_1, sdf_file_2, labels_by = mode["value"], condition_operator = condition_operator, condition_value = condition_value), session_id),
+                                             lambda ids: store.exists_all([ids[key] for key in STORED_KEYS]), on_wait = st_queue_status())
                         status = 0
                     except Exception as e:
                         this_e = st.exception(e)
@@ -264,29 +340,27 @@ def main():
         else:
             res_status = st.error("Scoring stopped prematurely! See log for more information!")
 
-    if result != None:
-        st.session_state["model_statistics"] = result["statistics"]
-        st.session_state["roc_plot_p"] = result["roc_plot_p"]
-        st.session_state["roc_plot_pp"] = result["roc_plot_pp"]
-        st.session_state["roc_plot_pm"] = result["roc_plot_pm"]
-        st.session_state["roc_plot_ppmm"] = result["roc_plot_ppmm"]
-        st.session_state["result_zip"] = result["zipfile"]
-        st.session_state["model_p"] = result["model_p"]
-        st.session_state["model_pp"] = result["model_pp"]
-        st.session_state["model_pm"] = result["model_pm"]
-        st.session_state["model_ppmm"] = result["model_ppmm"]
+    if result_ids != None:
+        for key in result_ids:
+            st.session_state[key] = result_ids[key]
+
+    # drop results that expired in the store
+    for key in STORED_KEYS:
+        if key in st.session_state and not store.exists(st.session_state[key]):
+            del st.session_state[key]
 
     col_1, col_2, col_3, col_4 = st.columns(4)
 
     with col_1:
-        if "model_statistics" in st.session_state and "roc_plot_p" in st.session_state:
+        if "model_statistics" in st.session_state and "roc_p" in st.session_state:
             sh_1 = st.subheader("Strategy +")
             if st.session_state["model_statistics"]["STRAT"]["best_strategy"] == "+":
                 best_val_1 = st.caption("Best-On-Validation Model")
             else:
                 best_val_1 = st.caption("Standard Model")
             desc_1 = st.markdown("**Metrics from the Test Partition:**")
-            roc_plot_1 = st.pyplot(st.session_state["roc_plot_p"])
+            roc_data_1, roc_spec_1 = roc_chart(st.session_state["roc_p"])
+            roc_plot_1 = st.vega_lite_chart(roc_data_1, roc_spec_1, use_container_width = True)
             mkdown_1 = "- **ACC:** " + str(round(st.session_state["model_statistics"]["TEST"]["+"]["ACC"], 5)) + "\n"
             mkdown_1 += "- **FPR:** " + str(round(st.session_state["model_statistics"]["TEST"]["+"]["FPR"], 5)) + "\n"
             mkdown_1 += "- **AUC:** " + str(round(st.session_state["model_statistics"]["TEST"]["+"]["AUC"], 5)) + "\n"
@@ -296,20 +370,28 @@ def main():
             metrics_1 = st.markdown(mkdown_1)
             if "model_p" in st.session_state:
                 model_1 = st.download_button(label = "Download Model!",
-                                             data = st.session_state["model_p"],
+                                             data = store.get_bytes(st.session_state["model_p"]),
                                              file_name = "model_p.piam",
                                              mime = "text/json",
                                              help = "Download Model+ in PIAM format."
                                              )
+            if "model_p_binary" in st.session_state:
+                model_1_binary = st.download_button(label = "Download Binary Model!",
+                                                    data = store.get_bytes(st.session_state["model_p_binary"]),
+                                                    file_name = "model_p.piamb",
+                                                    mime = "application/octet-stream",
+                                                    help = "Download Model+ in compact binary PIAM format, faster to load for large models."
+                                                    )
     with col_2:
-        if "model_statistics" in st.session_state and "roc_plot_pp" in st.session_state:
+        if "model_statistics" in st.session_state and "roc_pp" in st.session_state:
             sh_2 = st.subheader("Strategy ++")
             if st.session_state["model_statistics"]["STRAT"]["best_strategy"] == "++":
                 best_val_1 = st.caption("Best-On-Validation Model")
             else:
                 best_val_1 = st.caption("Standard Model")
             desc_2 = st.markdown("**Metrics from the Test Partition:**")
-            roc_plot_2 = st.pyplot(st.session_state["roc_plot_pp"])
+            roc_data_2, roc_spec_2 = roc_chart(st.session_state["roc_pp"])
+            roc_plot_2 = st.vega_lite_chart(roc_data_2, roc_spec_2, use_container_width = True)
             mkdown_2 = "- **ACC:** " + str(round(st.session_state["model_statistics"]["TEST"]["++"]["ACC"], 5)) + "\n"
             mkdown_2 += "- **FPR:** " + str(round(st.session_state["model_statistics"]["TEST"]["++"]["FPR"], 5)) + "\n"
             mkdown_2 += "- **AUC:** " + str(round(st.session_state["model_statistics"]["TEST"]["++"]["AUC"], 5)) + "\n"
@@ -319,21 +401,29 @@ def main():
             metrics_2 = st.markdown(mkdown_2)
             if "model_pp" in st.session_state:
                 model_2 = st.download_button(label = "Download Model!",
-                                             data = st.session_state["model_pp"],
+                                             data = store.get_bytes(st.session_state["model_pp"]),
                                              file_name = "model_pp.piam",
                                              mime = "text/json",
                                              help = "Download Model++ in PIAM format."
                                              )
+            if "model_pp_binary" in st.session_state:
+                model_2_binary = st.download_button(label = "Download Binary Model!",
+                                                    data = store.get_bytes(st.session_state["model_pp_binary"]),
+                                                    file_name = "model_pp.piamb",
+                                                    mime = "application/octet-stream",
+                                                    help = "Download Model++ in compact binary PIAM format, faster to load for large models."
+                                                    )
 
     with col_3:
-        if "model_statistics" in st.session_state and "roc_plot_pm" in st.session_state:
+        if "model_statistics" in st.session_state and "roc_pm" in st.session_state:
             sh_3 = st.subheader("Strategy +-")
             if st.session_state["model_statistics"]["STRAT"]["best_strategy"] == "+-":
                 best_val_1 = st.caption("Best-On-Validation Model")
             else:
                 best_val_1 = st.caption("Standard Model")
             desc_3 = st.markdown("**Metrics from the Test Partition:**")
-            roc_plot_3 = st.pyplot(st.session_state["roc_plot_pm"])
+            roc_data_3, roc_spec_3 = roc_chart(st.session_state["roc_pm"])
+            roc_plot_3 = st.vega_lite_chart(roc_data_3, roc_spec_3, use_container_width = True)
             mkdown_3 = "- **ACC:** " + str(round(st.session_state["model_statistics"]["TEST"]["+-"]["ACC"], 5)) + "\n"
             mkdown_3 += "- **FPR:** " + str(round(st.session_state["model_statistics"]["TEST"]["+-"]["FPR"], 5)) + "\n"
             mkdown_3 += "- **AUC:** " + str(round(st.session_state["model_statistics"]["TEST"]["+-"]["AUC"], 5)) + "\n"
@@ -343,21 +433,29 @@ def main():
             metrics_3 = st.markdown(mkdown_3)
             if "model_pm" in st.session_state:
                 model_3 = st.download_button(label = "Download Model!",
-                                             data = st.session_state["model_pm"],
+                                             data = store.get_bytes(st.session_state["model_pm"]),
                                              file_name = "model_pm.piam",
                                              mime = "text/json",
                                              help = "Download Model+- in PIAM format."
                                              )
+            if "model_pm_binary" in st.session_state:
+                model_3_binary = st.download_button(label = "Download Binary Model!",
+                                                    data = store.get_bytes(st.session_state["model_pm_binary"]),
+                                                    file_name = "model_pm.piamb",
+                                                    mime = "application/octet-stream",
+                                                    help = "Download Model+- in compact binary PIAM format, faster to load for large models."
+                                                    )
 
     with col_4:
-        if "model_statistics" in st.session_state and "roc_plot_ppmm" in st.session_state:
+        if "model_statistics" in st.session_state and "roc_ppmm" in st.session_state:
             sh_4 = st.subheader("Strategy ++--")
             if st.session_state["model_statistics"]["STRAT"]["best_strategy"] == "++--":
                 best_val_1 = st.caption("Best-On-Validation Model")
             else:
                 best_val_1 = st.caption("Standard Model")
             desc_4 = st.markdown("**Metrics from the Test Partition:**")
-            roc_plot_4 = st.pyplot(st.session_state["roc_plot_ppmm"])
+            roc_data_4, roc_spec_4 = roc_chart(st.session_state["roc_ppmm"])
+            roc_plot_4 = st.vega_lite_chart(roc_data_4, roc_spec_4, use_container_width = True)
             mkdown_4 = "- **ACC:** " + str(round(st.session_state["model_statistics"]["TEST"]["++--"]["ACC"], 5)) + "\n"
             mkdown_4 += "- **FPR:** " + str(round(st.session_state["model_statistics"]["TEST"]["++--"]["FPR"], 5)) + "\n"
             mkdown_4 += "- **AUC:** " + str(round(st.session_state["model_statistics"]["TEST"]["++--"]["AUC"], 5)) + "\n"
@@ -367,18 +465,82 @@ def main():
             metrics_4 = st.markdown(mkdown_4)
             if "model_ppmm" in st.session_state:
                 model_4 = st.download_button(label = "Download Model!",
-                                             data = st.session_state["model_ppmm"],
+                                             data = store.get_bytes(st.session_state["model_ppmm"]),
                                              file_name = "model_ppmm.piam",
                                              mime = "text/json",
                                              help = "Download Model++-- in PIAM format."
                                              )
+            if "model_ppmm_binary" in st.session_state:
+                model_4_binary = st.download_button(label = "Download Binary Model!",
+                                                    data = store.get_bytes(st.session_state["model_ppmm_binary"]),
+                                                    file_name = "model_ppmm.piamb",
+                                                    mime = "application/octet-stream",
+                                                    help = "Download Model++-- in compact binary PIAM format, faster to load for large models."
+                                                    )
+
+    with st.expander("[Optional] Sweep over splits and split sizes:"):
+        sweep_text = st.markdown("Train models on many random splits to compare split sizes and strategies. Every split is trained by PIA like above, splits are trained in parallel. Interactions are extracted for every split, a sweep takes as long as the number of splits times a single training divided by the number of workers.")
+        sweep_repeats = st.number_input(label = "Number of random splits:",
+                                        min_value = 2,
+                                        max_value = 100,
+                                        value = 10,
+                                        step = 1,
+                                        help = "Number of random splits per combination of sizes."
+                                        )
+        sweep_test_sizes = st.text_input(label = "Test sizes:",
+                                         value = "0.2, 0.3",
+                                         help = "Comma separated list of test partition sizes."
+                                         )
+        sweep_val_sizes = st.text_input(label = "Validation sizes:",
+                                        value = "0.2, 0.3",
+                                        help = "Comma separated list of validation partition sizes relative to the remaining training data."
+                                        )
+        if st.button("Run Sweep!", help = "Train models on all splits based on the given input."):
+            # expanders can't be nested, log directly inside the sweep expander
+            with st_stdout("info"):
+                if pdb_file != None and sdf_file_1 != None:
+                    try:
+                        test_sizes = [float(i.strip()) for i in sweep_test_sizes.split(",")]
+                        val_sizes = [float(i.strip()) for i in sweep_val_sizes.split(",")]
+                        st.session_state["sweep_summary"] = run_job(job_key("sweep", pdb_file, sdf_file_1, sdf_file_2, "best", test_sizes, val_sizes, int(sweep_repeats),
+                                                                            mode["value"], condition_operator, condition_value),
+                                                                    session_id, lambda: count_poses(sdf_file_1) + count_poses(sdf_file_2),
+                                                                    lambda: store.put_table(score_sweep(pdb_file, sdf_file_1, sdf_file_2,
+                                                                                                        test_sizes = test_sizes, val_sizes = val_sizes,
+                                                                                                        repeats = int(sweep_repeats),
+                                                                                                        labels_by = mode["value"], condition_operator = condition_operator,
+                                                                                                        condition_value = condition_value)["summary"], session = session_id),
+                                                                    store.exists, on_wait = st_queue_status())
+                        status_sweep = 0
+                    except Exception as e:
+                        this_e = st.exception(e)
+                        status_sweep = 1
+                else:
+                    status_sweep = 1
+                    no_file = st.error("Error: PDB and SDF have to be both provided for scoring!")
+            if status_sweep == 0:
+                res_status_sweep = st.success("Sweep finished successfully!")
+            else:
+                res_status_sweep = st.error("Sweep stopped prematurely! See log for more information!")
+
+        if "sweep_summary" in st.session_state and not store.exists(st.session_state["sweep_summary"]):
+            del st.session_state["sweep_summary"]
+
+        if "sweep_summary" in st.session_state:
+            sweep_summary = store.get_table(st.session_state["sweep_summary"])
+            sweep_table = st.dataframe(sweep_summary)
+            sweep_csv = st.download_button(label = "Download Sweep Results!",
+                                           data = sweep_summary.to_csv(index = False),
+                                           file_name = "sweep.csv",
+                                           mime = "text/csv",
+                                           help = "Download mean and variance of the metrics of every strategy in CSV file format."
+                                           )
 
     if "result_zip" in st.session_state:
         with st.expander("Download all Results:"):
-            with open(st.session_state["result_zip"], "rb") as f:
-                all_zip = st.download_button(label = "Download ZIP of all results!",
-                                             data = f,
-                                             file_name = st.session_state["result_zip"],
-                                             mime = "application/zip",
-                                             help = "Download all generated result files compressed in ZIP file format!"
-                                             )
+            all_zip = st.download_button(label = "Download ZIP of all results!",
+                                         data = store.get_bytes(st.session_state["result_zip"]),
+                                         file_name = st.session_state["result_zip_name"],
+                                         mime = "application/zip",
+                                         help = "Download all generated result files compressed in ZIP file format!"
+                                         )
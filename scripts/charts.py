@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+# PIAWEB - CLIENT-SIDE CHARTS
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+# Charts are rendered by the browser with vega-lite, the server only sends the numbers. Matplotlib figures are
+# only drawn for files that are downloaded, e.g. the zip archive of the scoring workflow.
+
+import json
+import pandas as pd
+
+# interaction frequencies as json text, in the order of the result
+def frequencies_to_json(i_frequencies):
+    return json.dumps({"interaction": [str(key) for key in i_frequencies],
+                       "frequency": [float(i_frequencies[key]) for key in i_frequencies]})
+
+# roc curve as dict of plain lists, e.g. from numpy arrays
+def roc_to_dict(fpr, tpr):
+    return {"fpr": [float(i) for i in fpr], "tpr": [float(i) for i in tpr]}
+
+# bar chart of interaction frequencies: data and vega-lite spec for st.vega_lite_chart
+def frequency_chart(frequencies_json, title = None):
+    data = pd.DataFrame(json.loads(frequencies_json))
+    spec = {"mark": {"type": "bar", "tooltip": True},
+            "encoding": {"x": {"field": "interaction", "type": "nominal", "sort": None, "title": "Interaction",
+                               "axis": {"labelAngle": -90}},
+                         "y": {"field": "frequency", "type": "quantitative", "title": "Frequency"}},
+            "height": 400}
+    if title != None:
+        spec["title"] = title
+    return data, spec
+
+# roc curve with the diagonal of a random classifier: data and vega-lite spec for st.vega_lite_chart
+def roc_chart(roc, title = None):
+    data = pd.DataFrame({"fpr": roc["fpr"], "tpr": roc["tpr"], "order": range(len(roc["fpr"]))})
+    axes = {"x": {"field": "fpr", "type": "quantitative", "title": "False Positive Rate", "scale": {"domain": [0, 1]}},
+            "y": {"field": "tpr", "type": "quantitative", "title": "True Positive Rate", "scale": {"domain": [0, 1]}}}
+    spec = {"layer": [{"mark": {"type": "line", "tooltip": True},
+                       "encoding": dict(axes, order = {"field": "order", "type": "quantitative"})},
+                      {"data": {"values": [{"fpr": 0, "tpr": 0}, {"fpr": 1, "tpr": 1}]},
+                       "mark": {"type": "line", "strokeDash": [4, 4], "color": "gray"},
+                       "encoding": axes}]}
+    if title != None:
+        spec["title"] = title
+    return data, spec
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# PIAWEB - PDB DOWNLOADS
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+# Structures are downloaded gzip compressed as .pdb.gz. Interrupted transfers are resumed with range requests and
+# retried with increasing delays. The compressed file is decompressed as a stream, which also checks its gzip
+# checksum, truncated or corrupt files are deleted and downloaded again. The structure has to contain atom records.
+# Entries that are only available as mmCIF (more than 99,999 atoms, chain IDs with more than one character or too
+# many chains) can't be written as PDB files without corrupting atom serials and chains, so they are rejected.
+# Codes that can't be downloaded are skipped with a warning instead of stopping the whole run.
+
+import os
+import gzip
+import time
+import zlib
+import shutil
+import http.client
+import urllib.error
+import urllib.request as ur
+
+# number of retries of a failed transfer and delay before the first retry in seconds, doubled for every retry
+RETRIES = 3
+RETRY_DELAY = 1.0
+TIMEOUT = 60
+
+CHUNK_SIZE = 64 * 1024
+
+# download a file, a partially downloaded file is resumed with a range request, 404 is not retried
+def fetch(url, filename, retries = RETRIES, retry_delay = RETRY_DELAY, timeout = TIMEOUT):
+
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(filename) if os.path.isfile(filename) else 0
+        request = ur.Request(url, headers = {"Range": "bytes=" + str(offset) + "-"} if offset > 0 else {})
+        try:
+            with ur.urlopen(request, timeout = timeout) as response:
+                # servers that don't support ranges send the whole file again
+                mode = "ab" if offset > 0 and response.status == 206 else "wb"
+                length = response.headers.get("Content-Length")
+                with open(filename, mode) as f:
+                    start = f.tell()
+                    shutil.copyfileobj(response, f, CHUNK_SIZE)
+                    received = f.tell() - start
+            if length is not None and received < int(length):
+                raise OSError("incomplete transfer, received " + str(received) + " of " + str(length) + " bytes")
+            return filename
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                raise
+            if e.code == 416:
+                # the partial file doesn't match the file on the server anymore, start over
+                os.remove(filename)
+            error = e
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            error = e
+        if attempt < retries:
+            print("Download of " + url + " failed (" + str(error) + "), retrying in " + str(retry_delay * 2 ** attempt) + " s.")
+            time.sleep(retry_delay * 2 ** attempt)
+
+    raise error
+
+# decompress a gzip file as a stream and return the number of atom records, truncated or corrupt files raise an error
+def decompress(gz_file, filename, records = ("ATOM", "HETATM")):
+    nr_records = 0
+    with gzip.open(gz_file, "rb") as source:
+        with open(filename, "wb") as f:
+            for line in source:
+                if line.startswith(tuple([record.encode("ascii") for record in records])):
+                    nr_records += 1
+                f.write(line)
+    return nr_records
+
+# check if a file is available on the server without downloading it
+def available(url, timeout = TIMEOUT):
+    try:
+        with ur.urlopen(ur.Request(url, method = "HEAD"), timeout = timeout):
+            return True
+    except (urllib.error.URLError, http.client.HTTPException, OSError):
+        return False
+
+# download a structure in PDB format, truncated or corrupt downloads are deleted and downloaded again
+def download_structure(code, filename, base_url, retries = RETRIES, retry_delay = RETRY_DELAY):
+
+    try:
+        for attempt in range(retries + 1):
+            try:
+                fetch(base_url + code + ".pdb.gz", filename + ".gz", retries, retry_delay)
+            except urllib.error.HTTPError as e:
+                if e.code == 404 and available(base_url + code + ".cif.gz"):
+                    raise ValueError(code + " is only available in mmCIF format (e.g. more than 99,999 atoms or multi-character chain IDs), which can't be analyzed as PDB file!")
+                raise
+            try:
+                nr_atoms = decompress(filename + ".gz", filename)
+                break
+            except (OSError, EOFError, zlib.error) as e:
+                # resuming would only append to the broken file, start over
+                os.remove(filename + ".gz")
+                if attempt == retries:
+                    raise ValueError("Downloaded file of " + code + " is corrupt: " + str(e))
+                print("Downloaded file of " + code + " is corrupt (" + str(e) + "), downloading it again.")
+                time.sleep(retry_delay * 2 ** attempt)
+    finally:
+        if os.path.isfile(filename + ".gz"):
+            os.remove(filename + ".gz")
+
+    if nr_atoms == 0:
+        os.remove(filename)
+        raise ValueError("Downloaded structure of " + code + " contains no atoms!")
+
+    return filename
+
+# download the structures of a list of PDB codes, codes that fail are skipped with a warning,
+# returns the filenames of the downloaded structures and the skipped codes
+def download_structures(list_of_codes, output_name_prefix, base_url, retries = RETRIES, retry_delay = RETRY_DELAY):
+
+    structures = []
+    skipped = []
+    for code in list_of_codes:
+        code = code[:-4] if code.lower().endswith(".pdb") else code
+        filename = output_name_prefix + code + ".pdb"
+        try:
+            structures.append(download_structure(code, filename, base_url, retries, retry_delay))
+            print("Downloaded ", code + ".pdb")
+        except Exception as e:
+            if os.path.isfile(filename):
+                os.remove(filename)
+            skipped.append(code)
+            print("Warning: Skipped " + code + ", download failed: " + str(e))
+
+    return structures, skipped
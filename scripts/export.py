@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# PIAWEB - RESULT EXPORT
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+import os
+import re
+import csv
+import json
+import importlib.util
+from collections import Counter
+
+# interactions are named like "Hydrogen_Bond:TYR383A", residue numbers can be negative and have insertion codes,
+# e.g. "Hydrogen_Bond:TYR-1A" or "Salt_Bridge:ASP52AB"
+INTERACTION_PATTERN = re.compile(r"^[A-Za-z][A-Za-z_\-]*:[A-Za-z0-9]+-?[0-9]+[A-Za-z0-9]*$")
+
+# write interaction frequencies in csv format row by row to a text file handle
+def write_csv(i_frequencies, f):
+    writer = csv.writer(f, lineterminator = "\n")
+    writer.writerow(["Interaction", "Frequency"])
+    for key in i_frequencies:
+        writer.writerow([key, i_frequencies[key]])
+
+# write any json serializable object chunk by chunk to a text file handle
+def write_json(obj, f):
+    for chunk in json.JSONEncoder().iterencode(obj):
+        f.write(chunk)
+
+# count the interactions in the result of a single structure, interactions can either be given as counts or as lists
+def _count_interactions(node, counts):
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if isinstance(key, str) and INTERACTION_PATTERN.match(key) and isinstance(value, (int, float)) and not isinstance(value, bool):
+                counts[key] += value
+            else:
+                _count_interactions(value, counts)
+    elif isinstance(node, (list, tuple)):
+        for value in node:
+            if isinstance(value, str) and INTERACTION_PATTERN.match(value):
+                counts[value] += 1
+            else:
+                _count_interactions(value, counts)
+    return counts
+
+# key of a structure in a PIA result, results are keyed by the structure files PIA was given, with or without path
+def structure_key(result, structure):
+    if structure in result:
+        return structure
+    for key in result:
+        if os.path.basename(str(key)) == os.path.basename(structure):
+            return key
+    return None
+
+# entry of a structure in a PIA result
+def _structure_entry(result, structure):
+    key = structure_key(result, structure)
+    return result[key] if key is not None else None
+
+# interactions of a structure in a PIA result as counts of interaction names, None if the structure is not part of
+# the result
+def structure_interactions(result, structure):
+    entry = _structure_entry(result, structure)
+    return _count_interactions(entry, Counter()) if entry is not None else None
+
+# return per complex interactions of a PIA result as columns "complex", "interaction" and "count", complexes are
+# given as dict of the analyzed structure files and their names, all other entries of the result are ignored
+def interaction_table(result, complexes):
+    table = {"complex": [], "interaction": [], "count": []}
+    for structure, complex_name in complexes.items():
+        interactions = structure_interactions(result, structure)
+        if interactions is None:
+            continue
+        for interaction, count in interactions.items():
+            table["complex"].append(complex_name)
+            table["interaction"].append(interaction)
+            table["count"].append(count)
+    return table
+
+# convert a column dict to an arrow table, pyarrow is only needed for columnar export
+def to_arrow(table):
+    import pyarrow as pa
+    return pa.table(table)
+
+# write a column dict to a binary file handle in parquet format
+def write_parquet(table, f):
+    import pyarrow.parquet as pq
+    pq.write_table(to_arrow(table), f, compression = "snappy")
+
+# check if columnar export is available
+def columnar_export_available():
+    return importlib.util.find_spec("pyarrow") is not None
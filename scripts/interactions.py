@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# PIAWEB - INTERACTION PROFILES
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+# Interaction profiles are extracted with PIA like in Workflow I: the complexes of all poses are analyzed by PIA once
+# and the profile of every complex is read from PIA's result, so every model scores the same interactions that
+# PIA's own prediction would use.
+
+import os
+import shutil
+from scripts.spatial import crop_complexes
+from scripts.export import structure_interactions
+
+# return path of a generated complex structure
+def _structure_path(structure, structures_directory):
+    if os.path.isfile(structure):
+        return structure
+    return os.path.join(structures_directory, structure)
+
+# write a complex of the host and every pose of an SD file to structures_directory like PIA does, with crop = True
+# every complex is cropped to the ligand and the pocket around it (see scripts.spatial.crop_complex) before any
+# interactions are detected, returns the ligand names and the complex structures as returned by PIA, the host
+# without ligands is written to pdb_file + "_cleaned.pdb" and has to be removed by the caller
+def prepare_complexes(pdb_file, sdf_file, structures_directory, crop = True):
+
+    from PIA.PIA import Preparation
+
+    p = Preparation()
+    p.remove_ligands(pdb_file, pdb_file + "_cleaned.pdb")
+    ligands = p.get_ligands(sdf_file)
+    sdf_metainfo = p.get_sdf_metainfo(sdf_file)
+    ligand_names = sdf_metainfo["names"]
+    structures = p.add_ligands_multi(pdb_file + "_cleaned.pdb", structures_directory, ligands)
+    if crop:
+        nr_cropped = crop_complexes([_structure_path(structure, structures_directory) for structure in structures], pdb_file + "_cleaned.pdb")
+        print("Cropped " + str(nr_cropped) + " of " + str(len(structures)) + " complexes to the binding pocket.")
+
+    return ligand_names, structures
+
+# extract the interaction profile of every pose in an SD file docked into the given host structure with PIA,
+# with crop = True every complex is cropped to the pocket around the ligand before it is analyzed
+def extract_profiles(pdb_file, sdf_file, tmp_dir_name = "piaweb_structures_tmp", crop = True):
+
+    from PIA.PIA import PIA
+
+    # create necessary directories
+    structures_path = os.path.join(os.getcwd(), tmp_dir_name)
+    os.mkdir(structures_path)
+
+    try:
+        ligand_names, structures = prepare_complexes(pdb_file, sdf_file, tmp_dir_name, crop)
+        result = PIA(structures, ligand_names = ligand_names, poses = "all", path = "current")
+        profiles = []
+        for structure in structures:
+            profile = structure_interactions(result.result, structure)
+            if profile is None:
+                raise ValueError("Structure " + os.path.basename(structure) + " is missing in the result of PIA!")
+            profiles.append(profile)
+    finally:
+        # cleanup
+        shutil.rmtree(tmp_dir_name)
+        if os.path.isfile(pdb_file + "_cleaned.pdb"):
+            os.remove(pdb_file + "_cleaned.pdb")
+
+    return {"names": ligand_names, "structures": [os.path.basename(s) for s in structures], "profiles": profiles}
+
+# score an interaction profile with the given strategy:
+# "+" counts every positive interaction once, "++" counts all occurrences of positive interactions,
+# "+-" and "++--" additionally subtract negative interactions the same way
+def score_profile(profile, positives, negatives, strategy = "+"):
+    score = 0
+    for interaction in positives:
+        if interaction in profile:
+            score += profile[interaction] if strategy in ["++", "++--"] else 1
+    if strategy in ["+-", "++--"]:
+        for interaction in negatives:
+            if interaction in profile:
+                score -= profile[interaction] if strategy == "++--" else 1
+    return score
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# PIAWEB - DEDUPLICATION OF IDENTICAL JOBS
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+import time
+import hashlib
+import threading
+from concurrent.futures import Future, CancelledError
+from collections import OrderedDict
+from scripts.store import STORE_TTL
+from scripts.scheduler import get_scheduler
+
+# maximum number of completed jobs that are remembered
+MAX_COMPLETED_JOBS = 1000
+
+# hash of the input files and parameters of a job, files can be given as uploaded files or bytes
+def job_key(*parts):
+
+    sha = hashlib.sha256()
+    for part in parts:
+        if part is None:
+            data = b"None"
+        elif isinstance(part, (bytes, bytearray, memoryview)):
+            data = part
+        elif hasattr(part, "getbuffer"):
+            data = part.getbuffer()
+        else:
+            data = repr(part).encode("utf-8")
+        # length prefix so that different splits of the same bytes give different keys
+        sha.update(str(len(data)).encode("utf-8") + b":")
+        sha.update(data)
+
+    return sha.hexdigest()
+
+# identical jobs are only computed once: a second identical request attaches to the running job
+# or gets the result of the completed job as long as it is still valid
+class JobRegistry:
+
+    def __init__(self, ttl = STORE_TTL, max_completed = MAX_COMPLETED_JOBS):
+        self.ttl = ttl
+        self.max_completed = max_completed
+        self.running = {}
+        self.completed = OrderedDict()
+        self.lock = threading.Lock()
+
+    # run function() for the given key, is_valid(result) can be used to check if a completed result is still usable,
+    # it is called outside of the lock because it may check the result store
+    def run(self, key, function, is_valid = None):
+
+        while True:
+            with self.lock:
+                completed = self.completed.get(key)
+            if completed is not None:
+                result, finished = completed
+                if time.time() - finished < self.ttl and (is_valid is None or is_valid(result)):
+                    print("Found result of an identical job, skipping computation.")
+                    return result
+                with self.lock:
+                    if self.completed.get(key) is completed:
+                        del self.completed[key]
+
+            with self.lock:
+                if key in self.completed:
+                    # an identical job finished in the meantime, check its result
+                    continue
+                if key in self.running:
+                    future = self.running[key]
+                    leader = False
+                else:
+                    future = Future()
+                    self.running[key] = future
+                    leader = True
+
+            if not leader:
+                print("An identical job is already running, waiting for its result.")
+                try:
+                    return future.result()
+                except CancelledError:
+                    # the running job was interrupted (e.g. stopped by its session), one of the waiting jobs takes over
+                    continue
+
+            try:
+                result = function()
+            except Exception as e:
+                with self.lock:
+                    del self.running[key]
+                future.set_exception(e)
+                raise
+            except BaseException:
+                # stop, rerun and keyboard interrupts belong to the session of this job and are not passed on
+                with self.lock:
+                    del self.running[key]
+                future.cancel()
+                raise
+
+            with self.lock:
+                del self.running[key]
+                self.completed[key] = (result, time.time())
+                while len(self.completed) > self.max_completed:
+                    self.completed.popitem(last = False)
+            future.set_result(result)
+
+            return result
+
+# one registry per server process, shared by all sessions
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = JobRegistry()
+    return _registry
+
+# run a heavy job of a user: identical jobs share one computation, which waits for free resources of the scheduler,
+# count() returns the number of poses (or structures) of the job and is only called if the job has to be computed,
+# e.g. compressed uploads are only decompressed for counting if no valid result of an identical job exists
+def run_job(key, user, count, function, is_valid = None, on_wait = None, registry = None, scheduler = None):
+    registry = registry if registry is not None else get_registry()
+    scheduler = scheduler if scheduler is not None else get_scheduler()
+    return registry.run(key, lambda: scheduler.run(user, count(), function, on_wait = on_wait), is_valid)
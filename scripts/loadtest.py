@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+
+# PIAWEB - LOAD TEST
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+# N simulated clients run the workflows of the Base, Score and Predict pages concurrently and through the same
+# job registry, scheduler and result store as the pages. Inputs are synthetic and generated on start, PDB codes
+# are served by a local HTTP server that stands in for RCSB. Reports throughput, latency percentiles and CPU and
+# RSS of the server process over time, e.g.:
+#
+#   python -m scripts.loadtest --clients 8 --requests 3 --workflows codes,sdf,score,predict --output loadtest
+#
+# writes loadtest_requests.csv (one row per request) and loadtest_samples.csv (one row per sample interval).
+
+import io
+import os
+import re
+import sys
+import gzip
+import time
+import uuid
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+WORKFLOWS = ["codes", "sdf", "score", "predict"]
+
+# residue templates for synthetic hosts: atom name, element and coordinates relative to the residue origin
+BACKBONE = [("N", "N", (1.317, 0.962, 1.014)), ("CA", "C", (-0.020, 0.426, 1.300)), ("C", "C", (-0.109, 0.047, 2.756)),
+            ("O", "O", (0.879, -0.317, 3.346)), ("CB", "C", (-0.270, -0.809, 0.434))]
+SIDECHAINS = {"PHE": [("CG", "C", (-0.181, -0.430, -1.020)), ("CD1", "C", (1.031, -0.498, -1.680)), ("CD2", "C", (-1.314, -0.018, -1.698)),
+                      ("CE1", "C", (1.112, -0.150, -3.014)), ("CE2", "C", (-1.231, 0.333, -3.032)), ("CZ", "C", (-0.018, 0.265, -3.691))],
+              "LYS": [("CG", "C", (-0.181, -0.430, -1.020)), ("CD", "C", (-0.431, -1.665, -1.886)), ("CE", "C", (-0.342, -1.286, -3.340)),
+                      ("NZ", "N", (-0.592, -2.521, -4.206))],
+              "ASP": [("CG", "C", (-0.181, -0.430, -1.020)), ("OD1", "O", (0.900, -0.100, -1.600)), ("OD2", "O", (-1.200, -0.300, -1.700))],
+              "SER": [("OG", "O", (-0.181, -0.430, -0.960))],
+              "LEU": [("CG", "C", (-0.181, -0.430, -1.020)), ("CD1", "C", (1.031, -0.498, -1.680)), ("CD2", "C", (-1.314, -0.018, -1.698))]}
+
+# phenol as synthetic ligand: atom elements, coordinates and bonds (kekulized ring)
+LIGAND_ATOMS = [("C", (1.39 * np.cos(k * np.pi / 3), 1.39 * np.sin(k * np.pi / 3), 0.0)) for k in range(6)] + [("O", (2.75, 0.0, 0.0))]
+LIGAND_BONDS = [(1, 2, 2), (2, 3, 1), (3, 4, 2), (4, 5, 1), (5, 6, 2), (6, 1, 1), (1, 7, 1)]
+
+# spacing of the residue grid of synthetic hosts
+GRID_SPACING = 7.0
+
+# grid of residues as host structure in PDB format, returns the PDB string and the centers of the grid cells
+def synthetic_host(size = 5):
+
+    residue_names = sorted(SIDECHAINS.keys())
+    lines = []
+    serial = 1
+    for i, (x, y, z) in enumerate([(x, y, z) for x in range(size) for y in range(size) for z in range(size)]):
+        origin = np.array([x, y, z], dtype = float) * GRID_SPACING
+        residue_name = residue_names[i % len(residue_names)]
+        for name, element, coordinates in BACKBONE + SIDECHAINS[residue_name]:
+            position = origin + np.array(coordinates)
+            lines.append(_atom_record("ATOM", serial, name, residue_name, "A", i + 1, position, element))
+            serial += 1
+    lines.append("TER")
+
+    centers = [(np.array([x, y, z], dtype = float) + 0.5) * GRID_SPACING for x in range(size - 1) for y in range(size - 1) for z in range(size - 1)]
+    return "\n".join(lines) + "\n", centers
+
+def _atom_record(record, serial, name, residue_name, chain, residue_number, position, element):
+    return (record.ljust(6) + str(serial).rjust(5) + "  " + name.ljust(3) + " " + residue_name.rjust(3) + " " + chain + str(residue_number).rjust(4) + "    " +
+            "".join([("%.3f" % c).rjust(8) for c in position]) + "  1.00  0.00          " + element.rjust(2))
+
+# random rigid placement of the synthetic ligand around a center
+def _place_ligand(center, rng, noise = 1.0):
+    q = rng.normal(size = 4)
+    a, b, c, d = q / np.linalg.norm(q)
+    rotation = np.array([[a*a + b*b - c*c - d*d, 2*(b*c - a*d), 2*(b*d + a*c)],
+                         [2*(b*c + a*d), a*a - b*b + c*c - d*d, 2*(c*d - a*b)],
+                         [2*(b*d - a*c), 2*(c*d + a*b), a*a - b*b - c*c + d*d]])
+    coordinates = np.array([atom[1] for atom in LIGAND_ATOMS])
+    return (coordinates - coordinates.mean(axis = 0)) @ rotation.T + center + rng.normal(scale = noise, size = 3)
+
+# docked poses of synthetic ligands in SDF format, every ligand has nr_poses poses around a random grid cell
+def synthetic_sdf(centers, nr_ligands, nr_poses, name_prefix, seed):
+
+    rng = np.random.default_rng(seed)
+    blocks = []
+    for i in range(nr_ligands):
+        center = centers[rng.integers(len(centers))]
+        for j in range(nr_poses):
+            coordinates = _place_ligand(center, rng)
+            block = [name_prefix + "_" + str(i + 1), "  PIAWeb synthetic ligand", ""]
+            block.append(str(len(LIGAND_ATOMS)).rjust(3) + str(len(LIGAND_BONDS)).rjust(3) + "  0  0  0  0  0  0  0  0999 V2000")
+            for (element, _), position in zip(LIGAND_ATOMS, coordinates):
+                block.append("".join([("%.4f" % c).rjust(10) for c in position]) + " " + element.ljust(3) + " 0  0  0  0  0  0  0  0  0  0  0  0")
+            for a, b, order in LIGAND_BONDS:
+                block.append(str(a).rjust(3) + str(b).rjust(3) + str(order).rjust(3) + "  0")
+            block += ["M  END", "$$$$"]
+            blocks.append("\n".join(block))
+
+    return "\n".join(blocks) + "\n"
+
+# host structure with a bound synthetic ligand as it would be served by RCSB
+def synthetic_complex(host, centers, seed):
+    rng = np.random.default_rng(seed)
+    coordinates = _place_ligand(centers[rng.integers(len(centers))], rng)
+    serial = host.count("\nATOM") + 2
+    lines = [_atom_record("HETATM", serial + k, element + str(k + 1), "LIG", "B", 1, position, element)
+             for k, ((element, _), position) in enumerate(zip(LIGAND_ATOMS, coordinates))]
+    return host + "\n".join(lines) + "\nEND\n"
+
+# uploaded file as the pages get it from st.file_uploader
+class SyntheticUpload(io.BytesIO):
+
+    def __init__(self, name, data):
+        io.BytesIO.__init__(self, data)
+        self.name = name
+        self.id = uuid.uuid4().hex
+        self.size = len(data)
+
+# local stand-in for RCSB, serves files from a dict of {path: bytes}, everything else is 404,
+# supports range requests for resumed downloads
+def start_file_server(files):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            data = files.get(self.path.lstrip("/"))
+            if data is None:
+                self.send_error(404)
+                return
+            match = re.match(r"^bytes=(\d+)-$", self.headers.get("Range", ""))
+            if match is not None:
+                offset = int(match.group(1))
+                if offset >= len(data):
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes " + str(offset) + "-" + str(len(data) - 1) + "/" + str(len(data)))
+                data = data[offset:]
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_HEAD(self):
+            data = files.get(self.path.lstrip("/"))
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+
+        # keep the report readable
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+# resident set size of this process in bytes
+def _rss():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # peak instead of current usage, in kB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# cpu time of this process and its finished children in seconds
+def _cpu_time():
+    usage = [resource.getrusage(who) for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+    return sum([u.ru_utime + u.ru_stime for u in usage])
+
+# samples cpu utilization, rss and the scheduler queue every interval seconds until stopped
+class Sampler(threading.Thread):
+
+    def __init__(self, scheduler, interval = 1.0):
+        threading.Thread.__init__(self, daemon = True)
+        self.scheduler = scheduler
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        start = last_time = time.time()
+        last_cpu = _cpu_time()
+        while not self.stopped.wait(self.interval):
+            now, cpu = time.time(), _cpu_time()
+            status = self.scheduler.status()
+            self.samples.append({"TIME [s]": round(now - start, 2),
+                                 "CPU [%]": round(100 * (cpu - last_cpu) / max(now - last_time, 1e-6), 1),
+                                 "RSS [MB]": round(_rss() / (1024 * 1024), 1),
+                                 "RUNNING": status["running"],
+                                 "WAITING": status["waiting"]})
+            last_time, last_cpu = now, cpu
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+# run one request of a workflow the way the corresponding page does, returns nothing and raises on failure
+def run_workflow(workflow, inputs, session, shared):
+
+    from scripts import PIAWebBase, PIAWebScore, PIAWebPredict
+    from scripts.store import get_store
+    from scripts.jobs import get_registry, job_key
+    from scripts.scheduler import get_scheduler, count_poses
+
+    store = get_store()
+    jobs = get_registry()
+    scheduler = get_scheduler()
+    # unless requests are shared every request gets its own job key and is computed
+    nonce = None if shared else uuid.uuid4().hex
+
+    if workflow == "codes":
+        codes = inputs["codes"]
+        jobs.run(job_key("extract_codes", codes, True, nonce),
+                 lambda: scheduler.run(session, len(codes), lambda: PIAWebBase.store_result(PIAWebBase.extract_codes(codes), session)),
+                 store.exists_all)
+    elif workflow == "sdf":
+        pdb_file, sdf_file = inputs["upload"]("host.pdb"), inputs["upload"]("ligands.sdf")
+        jobs.run(job_key("extract_sdf", pdb_file, sdf_file, "best", True, nonce),
+                 lambda: scheduler.run(session, count_poses(sdf_file), lambda: PIAWebBase.store_result(PIAWebBase.extract_sdf(pdb_file, sdf_file, "best"), session)),
+                 store.exists_all)
+    elif workflow == "score":
+        pdb_file, sdf_file_1, sdf_file_2 = inputs["upload"]("host.pdb"), inputs["upload"]("actives.sdf"), inputs["upload"]("decoys.sdf")
+        jobs.run(job_key("score", pdb_file, sdf_file_1, sdf_file_2, nonce),
+                 lambda: scheduler.run(session, count_poses(sdf_file_1) + count_poses(sdf_file_2),
+                                       lambda: PIAWebScore.store_result(PIAWebScore.score(pdb_file, sdf_file_1, sdf_file_2), session)),
+                 lambda ids: store.exists_all([ids[key] for key in PIAWebScore.STORED_KEYS]))
+    elif workflow == "predict":
+        prefix = "loadtest_" + uuid.uuid4().hex
+        with open(prefix + "_host.pdb", "wb") as f:
+            f.write(inputs["files"]["host.pdb"])
+        with open(prefix + "_ligands.sdf", "wb") as f:
+            f.write(inputs["files"]["ligands.sdf"])
+        try:
+            jobs.run(job_key("predict_sdf", inputs["interactions"], 1, inputs["files"]["host.pdb"], inputs["files"]["ligands.sdf"], nonce),
+                     lambda: scheduler.run(session, count_poses(prefix + "_ligands.sdf"),
+                                           lambda: store.put_table(PIAWebPredict.predict_sdf(inputs["interactions"], prefix + "_host.pdb", prefix + "_ligands.sdf", cutoff = 1,
+                                                                                             tmp_dir_name = prefix + "_structures")["dataframe"], session = session)),
+                     store.exists)
+        finally:
+            for f in [prefix + "_host.pdb", prefix + "_ligands.sdf"]:
+                if os.path.isfile(f):
+                    os.remove(f)
+    else:
+        raise ValueError("Unknown workflow: " + str(workflow))
+
+# one simulated client: a session that sends its requests one after another
+def run_client(client, workflows, nr_requests, inputs, shared, start_barrier, records, lock):
+
+    session = "loadtest_" + str(client) + "_" + uuid.uuid4().hex[:8]
+    start_barrier.wait()
+    for i in range(nr_requests):
+        workflow = workflows[(client + i) % len(workflows)]
+        start = time.time()
+        error = ""
+        try:
+            run_workflow(workflow, inputs, session, shared)
+        except Exception as e:
+            error = type(e).__name__ + ": " + str(e)
+        with lock:
+            records.append({"CLIENT": client, "WORKFLOW": workflow, "START": start, "LATENCY [s]": time.time() - start,
+                            "STATUS": "ok" if error == "" else "error", "ERROR": error})
+
+# latency percentiles and throughput of a set of requests
+def summarize(requests, duration):
+    latencies = requests.loc[requests["STATUS"] == "ok", "LATENCY [s]"].to_numpy()
+    summary = {"REQUESTS": len(requests), "ERRORS": int((requests["STATUS"] != "ok").sum()),
+               "THROUGHPUT [1/min]": round(60 * len(latencies) / duration, 2) if duration > 0 else 0.0}
+    for p in [50, 95, 99]:
+        summary["P" + str(p) + " [s]"] = round(float(np.percentile(latencies, p)), 2) if len(latencies) > 0 else float("nan")
+    return summary
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Load test for PIAWeb with simulated concurrent clients.")
+    parser.add_argument("--clients", type = int, default = 4, help = "Number of concurrent clients (default: 4).")
+    parser.add_argument("--requests", type = int, default = 2, help = "Number of requests per client (default: 2).")
+    parser.add_argument("--workflows", default = ",".join(WORKFLOWS), help = "Comma separated workflows: " + ", ".join(WORKFLOWS) + " (default: all).")
+    parser.add_argument("--ligands", type = int, default = 20, help = "Number of synthetic ligands per SD file (default: 20).")
+    parser.add_argument("--poses", type = int, default = 5, help = "Number of poses per ligand (default: 5).")
+    parser.add_argument("--codes", type = int, default = 5, help = "Number of PDB codes per request (default: 5).")
+    parser.add_argument("--host-size", type = int, default = 5, help = "Edge length of the residue grid of the synthetic host (default: 5).")
+    parser.add_argument("--interval", type = float, default = 1.0, help = "Sampling interval of CPU and RSS in seconds (default: 1).")
+    parser.add_argument("--shared", action = "store_true", help = "Let identical requests share one computation like on the server.")
+    parser.add_argument("--seed", type = int, default = 0, help = "Seed of the synthetic inputs (default: 0).")
+    parser.add_argument("--output", default = "loadtest", help = "Prefix of the CSV reports (default: loadtest).")
+    args = parser.parse_args(argv)
+
+    workflows = [w.strip() for w in args.workflows.split(",") if w.strip() != ""]
+    for workflow in workflows:
+        if workflow not in WORKFLOWS:
+            parser.error("Unknown workflow: " + workflow)
+    output = os.path.abspath(args.output)
+
+    # synthetic inputs
+    host, centers = synthetic_host(args.host_size)
+    files = {"host.pdb": host.encode("utf-8"),
+             "ligands.sdf": synthetic_sdf(centers, args.ligands, args.poses, "ligand", args.seed).encode("utf-8"),
+             "actives.sdf": synthetic_sdf(centers, args.ligands, args.poses, "active", args.seed + 1).encode("utf-8"),
+             "decoys.sdf": synthetic_sdf(centers, args.ligands, args.poses, "decoy", args.seed + 2).encode("utf-8")}
+    codes = ["SYN" + str(i + 1) for i in range(args.codes)]
+    server = start_file_server({code + ".pdb.gz": gzip.compress(synthetic_complex(host, centers, args.seed + 10 + i).encode("utf-8")) for i, code in enumerate(codes)})
+    inputs = {"files": files, "codes": codes,
+              "upload": lambda name: SyntheticUpload(name, files[name]),
+              "interactions": ["Hydrophobic_Interaction:PHE" + str(i + 1) + "A" for i in range(args.host_size ** 3) if sorted(SIDECHAINS.keys())[i % len(SIDECHAINS)] == "PHE"]}
+
+    # the server is configured via environment, so pages are imported afterwards, working files go to a temporary directory
+    os.environ["PIAWEB_RCSB_URL"] = "http://127.0.0.1:" + str(server.server_address[1]) + "/"
+    working_directory = tempfile.mkdtemp(prefix = "piaweb_loadtest_")
+    cwd = os.getcwd()
+    os.chdir(working_directory)
+
+    from scripts.scheduler import get_scheduler
+    sampler = Sampler(get_scheduler(), args.interval)
+
+    records = []
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(args.clients + 1)
+    clients = [threading.Thread(target = run_client, args = (client, workflows, args.requests, inputs, args.shared, start_barrier, records, lock))
+               for client in range(args.clients)]
+
+    # workflows print their progress, only the report is shown
+    stdout = sys.stdout
+    try:
+        with open(os.devnull, "w") as devnull:
+            sys.stdout = devnull
+            for client in clients:
+                client.start()
+            sampler.start()
+            start = time.time()
+            start_barrier.wait()
+            for client in clients:
+                client.join()
+            duration = time.time() - start
+            sampler.stop()
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+        server.shutdown()
+        shutil.rmtree(working_directory, ignore_errors = True)
+
+    requests = pd.DataFrame(records, columns = ["CLIENT", "WORKFLOW", "START", "LATENCY [s]", "STATUS", "ERROR"])
+    requests["START"] = requests["START"] - start
+    samples = pd.DataFrame(sampler.samples, columns = ["TIME [s]", "CPU [%]", "RSS [MB]", "RUNNING", "WAITING"])
+    requests.to_csv(output + "_requests.csv", index = False)
+    samples.to_csv(output + "_samples.csv", index = False)
+
+    summary = pd.DataFrame([dict(summarize(requests[requests["WORKFLOW"] == w], duration), WORKFLOW = w) for w in workflows] +
+                           [dict(summarize(requests, duration), WORKFLOW = "all")]).set_index("WORKFLOW")
+    print("Load test with " + str(args.clients) + " clients finished in " + str(round(duration, 1)) + " s.")
+    print(summary.to_string())
+    if len(samples) > 0:
+        print("CPU: mean " + str(round(samples["CPU [%]"].mean(), 1)) + " %, max " + str(samples["CPU [%]"].max()) + " %. " +
+              "RSS: max " + str(samples["RSS [MB]"].max()) + " MB.")
+    for error in requests.loc[requests["STATUS"] != "ok", "ERROR"].unique()[:5]:
+        print("Error: " + error)
+    print("Reports written to " + output + "_requests.csv and " + output + "_samples.csv.")
+
+    return summary
+
+if __name__ == "__main__":
+    main()
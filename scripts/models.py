@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+# PIAWEB - BINARY MODEL FORMAT
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+# Binary models (.piamb) store the same information as JSON models (.piam) but the interactions are interned
+# in a sorted vocabulary and positives and negatives are stored as integer index arrays, so that models can be
+# memory-mapped instead of being parsed as a whole. All values are little-endian, sections are 8 byte aligned:
+#
+#   header      magic "PIAB", format version, flags, vocabulary size, number of positives and negatives,
+#               offsets of all sections and the length of the meta data
+#   offsets     uint32[vocabulary size + 1], start of every vocabulary entry in the string section
+#   strings     utf-8 encoded interactions sorted by their encoding, without separators
+#   positives   int32[number of positives], vocabulary indices in the order of the model
+#   negatives   int32[number of negatives], vocabulary indices in the order of the model
+#   meta        utf-8 encoded JSON of the model with positives and negatives set to null, keeps the order
+#               of keys and all other values (strategy, cutoff, statistics) so conversion is lossless
+
+import os
+import mmap
+import json
+import struct
+import numpy as np
+
+MAGIC = b"PIAB"
+VERSION = 1
+
+HEADER = struct.Struct("<4sHHIII6Q")
+
+# round up to the next multiple of 8
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+# check if a file, bytes or an uploaded file is a binary model
+def is_binary_model(model):
+    if hasattr(model, "getbuffer"):
+        return bytes(model.getbuffer()[:len(MAGIC)]) == MAGIC
+    if isinstance(model, (bytes, bytearray, memoryview)):
+        return bytes(model[:len(MAGIC)]) == MAGIC
+    with open(model, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+# encode a model given as dict to the binary format
+def encode_model(model):
+
+    for key in ["positives", "negatives"]:
+        if not isinstance(model.get(key), list) or not all(isinstance(i, str) for i in model[key]):
+            raise ValueError("Model " + key + " have to be a list of interactions!")
+
+    vocabulary = sorted(set([i.encode("utf-8") for i in model["positives"] + model["negatives"]]))
+    index = {interaction: i for i, interaction in enumerate(vocabulary)}
+    offsets = np.zeros(len(vocabulary) + 1, dtype = "<u4")
+    offsets[1:] = np.cumsum([len(interaction) for interaction in vocabulary])
+    strings = b"".join(vocabulary)
+    positives = np.array([index[i.encode("utf-8")] for i in model["positives"]], dtype = "<i4")
+    negatives = np.array([index[i.encode("utf-8")] for i in model["negatives"]], dtype = "<i4")
+    meta = json.dumps(dict(model, positives = None, negatives = None)).encode("utf-8")
+
+    sections = [offsets.tobytes(), strings, positives.tobytes(), negatives.tobytes(), meta]
+    section_offsets = []
+    offset = _align(HEADER.size)
+    for section in sections:
+        section_offsets.append(offset)
+        offset = _align(offset + len(section))
+
+    data = bytearray(offset)
+    HEADER.pack_into(data, 0, MAGIC, VERSION, 0, len(vocabulary), len(positives), len(negatives), *section_offsets, len(meta))
+    for section_offset, section in zip(section_offsets, sections):
+        data[section_offset:section_offset + len(section)] = section
+
+    return bytes(data[:section_offsets[-1] + len(meta)])
+
+# convert a model in json format to the binary format
+def json_to_binary(text):
+    return encode_model(json.loads(text))
+
+# convert a model in binary format to json, gives the same text as json.dumps of the original model
+def binary_to_json(data):
+    return json.dumps(BinaryModel(data = data).to_dict())
+
+# convert a model file from json to binary or vice versa, the format of the input is detected from its content
+def convert_model(source, target):
+    if is_binary_model(source):
+        model = BinaryModel(source)
+        try:
+            with open(target, "w", encoding = "utf-8") as f:
+                json.dump(model.to_dict(), f)
+        finally:
+            model.close()
+    else:
+        with open(source, "r", encoding = "utf-8") as f:
+            data = json_to_binary(f.read())
+        with open(target, "wb") as f:
+            f.write(data)
+    return target
+
+# read-only view of a binary model, files are memory-mapped and the vocabulary is only decoded on access
+class BinaryModel:
+
+    def __init__(self, filename = None, data = None):
+
+        self.file = None
+        self.buffer = None
+        self.strings = None
+        if filename is not None:
+            self.file = open(filename, "rb")
+            if os.fstat(self.file.fileno()).st_size == 0:
+                self.file.close()
+                raise ValueError("Not a binary PIAModel: file is empty!")
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+            data = self.buffer
+        elif data is None:
+            raise ValueError("Either filename or data has to be given!")
+
+        if len(data) < HEADER.size:
+            self.close()
+            raise ValueError("Not a binary PIAModel: file is too short!")
+        magic, version, flags, vocabulary_size, nr_positives, nr_negatives, offsets_offset, strings_offset, positives_offset, negatives_offset, meta_offset, meta_length = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("Not a binary PIAModel!")
+        if version > VERSION:
+            self.close()
+            raise ValueError("Binary PIAModel version " + str(version) + " is not supported, please update PIAWeb!")
+
+        self.version = version
+        self.vocabulary_size = vocabulary_size
+        self.offsets = np.frombuffer(data, dtype = "<u4", count = vocabulary_size + 1, offset = offsets_offset)
+        self.strings = memoryview(data)[strings_offset:strings_offset + int(self.offsets[-1])]
+        self.positive_ids = np.frombuffer(data, dtype = "<i4", count = nr_positives, offset = positives_offset)
+        self.negative_ids = np.frombuffer(data, dtype = "<i4", count = nr_negatives, offset = negatives_offset)
+        self.meta = json.loads(bytes(data[meta_offset:meta_offset + meta_length]).decode("utf-8"))
+        self.__weights = None
+
+    # interaction with the given vocabulary index
+    def interaction(self, i):
+        return bytes(self.strings[int(self.offsets[i]):int(self.offsets[i + 1])]).decode("utf-8")
+
+    # vocabulary index of an interaction by binary search in the sorted vocabulary, -1 if it is not part of the model
+    def lookup(self, interaction):
+        key = interaction.encode("utf-8")
+        low, high = 0, self.vocabulary_size
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self.strings[int(self.offsets[middle]):int(self.offsets[middle + 1])]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.vocabulary_size and bytes(self.strings[int(self.offsets[low]):int(self.offsets[low + 1])]) == key:
+            return low
+        return -1
+
+    @property
+    def positives(self):
+        return [self.interaction(i) for i in self.positive_ids]
+
+    @property
+    def negatives(self):
+        return [self.interaction(i) for i in self.negative_ids]
+
+    @property
+    def strategy(self):
+        return self.meta.get("strategy")
+
+    @property
+    def cutoff(self):
+        return self.meta.get("cutoff")
+
+    @property
+    def statistics(self):
+        return self.meta.get("statistics")
+
+    # model as dict in the same key order as the json model
+    def to_dict(self):
+        model = dict(self.meta)
+        model["positives"] = self.positives
+        model["negatives"] = self.negatives
+        return model
+
+    # score an interaction profile, gives the same scores as scripts.interactions.score_profile with the model
+    # positives and negatives but only looks up the interactions of the profile in the vocabulary
+    def score(self, profile, strategy = None):
+        strategy = strategy if strategy is not None else self.strategy
+        if strategy == "best":
+            strategy = self.statistics["STRAT"]["best_strategy"]
+        if self.__weights is None:
+            # how often every vocabulary entry occurs in positives and negatives
+            self.__weights = (np.bincount(self.positive_ids, minlength = self.vocabulary_size),
+                              np.bincount(self.negative_ids, minlength = self.vocabulary_size))
+        positive_weights, negative_weights = self.__weights
+        score = 0
+        for interaction, count in profile.items():
+            i = self.lookup(interaction)
+            if i < 0:
+                continue
+            score += int(positive_weights[i]) * (count if strategy in ["++", "++--"] else 1)
+            if strategy in ["+-", "++--"]:
+                score -= int(negative_weights[i]) * (count if strategy == "++--" else 1)
+        return score
+
+    # release the memory map, arrays of the model can't be used afterwards. The map can only be closed once no
+    # views of it are left, if arrays of the model are still referenced elsewhere (e.g. positive_ids) it is released
+    # when the last of them is garbage collected instead
+    def close(self):
+        if self.strings is not None:
+            self.strings.release()
+        self.offsets = None
+        self.strings = None
+        self.positive_ids = None
+        self.negative_ids = None
+        self.__weights = None
+        if self.buffer is not None:
+            try:
+                self.buffer.close()
+            except BufferError:
+                pass
+            self.buffer = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -6,6 +6,7 @@
 # micha.birklbauer@gmail.com
 
 import sys
+import uuid
 import streamlit as st
 from io import StringIO
 from threading import current_thread
@@ -45,3 +46,21 @@ def st_stdout(dst):
 def st_stderr(dst):
     with st_redirect(sys.stderr, dst):
         yield
+
+# unique id of the current session
+def get_session_id():
+    if "session_id" not in st.session_state:
+        st.session_state["session_id"] = uuid.uuid4().hex
+    return st.session_state["session_id"]
+
+# show the queue position of a job that waits for the scheduler
+def st_queue_status():
+    placeholder = st.empty()
+
+    def on_wait(position, nr_waiting):
+        if position > 0:
+            placeholder.info("Waiting for free resources: position " + str(position) + " of " + str(nr_waiting) + " in queue.")
+        else:
+            placeholder.empty()
+
+    return on_wait
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# PIAWEB - ADMISSION CONTROL AND FAIR SCHEDULING
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+from scripts.uploads import compression, open_upload, CHUNK_SIZE
+
+# scheduler limits, can be set via environment variables
+MAX_CONCURRENT_JOBS = int(os.environ.get("PIAWEB_MAX_CONCURRENT_JOBS", max(1, (os.cpu_count() or 2) // 2)))
+MAX_LARGE_JOBS = int(os.environ.get("PIAWEB_MAX_LARGE_JOBS", 1))
+LARGE_JOB_POSES = int(os.environ.get("PIAWEB_LARGE_JOB_POSES", 2000))
+MAX_POSES = int(os.environ.get("PIAWEB_MAX_POSES", 20000))
+LARGE_JOB_MAX_WAIT = float(os.environ.get("PIAWEB_LARGE_JOB_MAX_WAIT", 600))
+
+# raised if a job is too large to be admitted
+class JobRejected(ValueError):
+    pass
+
+# count lines starting with $$$$ in a buffer, the buffer is scanned in chunks so that large uploads are not copied
+def _count_in_buffer(buffer):
+
+    with memoryview(buffer) as view:
+        nr_poses = 1 if view[:4] == b"$$$$" else 0
+        # chunks overlap by four bytes so that separators on the border of two chunks are counted exactly once
+        for start in range(0, len(view), CHUNK_SIZE):
+            nr_poses += bytes(view[max(0, start - 4):start + CHUNK_SIZE]).count(b"\n$$$$")
+    return nr_poses
+
+# count poses in an SD file given as uploaded file, bytes or path
+def count_poses(sdf_file):
+
+    if sdf_file is None:
+        return 0
+    if hasattr(sdf_file, "getbuffer"):
+        if compression(sdf_file) == None:
+            return _count_in_buffer(sdf_file.getbuffer())
+        # compressed uploads are counted while they are decompressed
+        nr_poses = 0
+        with open_upload(sdf_file) as f:
+            for line in f:
+                if line.startswith(b"$$$$"):
+                    nr_poses += 1
+        return nr_poses
+    if isinstance(sdf_file, (bytes, bytearray)):
+        return _count_in_buffer(sdf_file)
+    nr_poses = 0
+    with open(sdf_file, "rb") as f:
+        for line in f:
+            if line.startswith(b"$$$$"):
+                nr_poses += 1
+    return nr_poses
+
+class Ticket:
+
+    def __init__(self, user, poses, large):
+        self.user = user
+        self.poses = poses
+        self.large = large
+        self.submitted = time.time()
+
+# global scheduler with a limit on concurrently running jobs, waiting jobs are served round robin
+# over users so that one user can't block everyone else by submitting many jobs, large jobs are
+# deferred behind normal jobs and only MAX_LARGE_JOBS of them run at the same time, large jobs that waited
+# longer than LARGE_JOB_MAX_WAIT seconds are not deferred anymore so that a stream of normal jobs can't starve them
+class Scheduler:
+
+    def __init__(self, max_concurrent = MAX_CONCURRENT_JOBS, max_large = MAX_LARGE_JOBS, large_poses = LARGE_JOB_POSES, max_poses = MAX_POSES,
+                 large_max_wait = LARGE_JOB_MAX_WAIT):
+        self.max_concurrent = max_concurrent
+        self.max_large = max_large
+        self.large_poses = large_poses
+        self.max_poses = max_poses
+        self.large_max_wait = large_max_wait
+        self.waiting = []
+        self.running = []
+        self.last_served = {}
+        self.condition = threading.Condition()
+
+    # waiting tickets in the order they will be started, lock has to be held by the caller
+    def __queue(self):
+        now = time.time()
+        rounds = {}
+        ordered = []
+        for ticket in self.waiting:
+            # the n-th waiting job of a user is started in round n, users that were served least recently go first
+            nr_round = rounds.get(ticket.user, 0)
+            rounds[ticket.user] = nr_round + 1
+            deferred = ticket.large and now - ticket.submitted < self.large_max_wait
+            ordered.append((deferred, nr_round, self.last_served.get(ticket.user, 0), ticket.submitted, ticket))
+        ordered.sort(key = lambda t: t[:4])
+        return [t[4] for t in ordered]
+
+    # check if a ticket can be started now, lock has to be held by the caller
+    def __can_start(self, ticket):
+        if len(self.running) >= self.max_concurrent:
+            return False
+        nr_large = len([t for t in self.running if t.large])
+        for candidate in self.__queue():
+            if candidate.large and nr_large >= self.max_large:
+                continue
+            return candidate is ticket
+        return False
+
+    # wait for a free slot, on_wait(position, nr_waiting) is called whenever the queue position changes
+    @contextmanager
+    def slot(self, user, poses = 0, on_wait = None):
+
+        if poses > self.max_poses:
+            raise JobRejected("Job rejected: " + str(poses) + " poses exceed the maximum of " + str(self.max_poses) + " poses per job on this server!")
+
+        ticket = Ticket(user, poses, poses >= self.large_poses)
+        with self.condition:
+            self.waiting.append(ticket)
+
+        try:
+            last_position = None
+            while True:
+                with self.condition:
+                    if self.__can_start(ticket):
+                        self.waiting.remove(ticket)
+                        self.running.append(ticket)
+                        self.last_served[user] = time.time()
+                        # other waiting jobs might be startable now too
+                        self.condition.notify_all()
+                        break
+                    queue = self.__queue()
+                    position = (queue.index(ticket) + 1, len(queue))
+                # report outside of the lock, the callback might be slow
+                if on_wait is not None and position != last_position:
+                    on_wait(*position)
+                    last_position = position
+                with self.condition:
+                    self.condition.wait(timeout = 1)
+        except BaseException:
+            # e.g. the user stopped the script while waiting
+            with self.condition:
+                if ticket in self.waiting:
+                    self.waiting.remove(ticket)
+                    self.condition.notify_all()
+            raise
+
+        if on_wait is not None and last_position is not None:
+            on_wait(0, 0)
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.running.remove(ticket)
+                self.condition.notify_all()
+
+    # run function() as soon as a slot is free
+    def run(self, user, poses, function, on_wait = None):
+        with self.slot(user, poses, on_wait):
+            return function()
+
+    # number of worker processes a single job may use, the cpus are shared by all slots
+    def workers_per_job(self):
+        return max(1, (os.cpu_count() or 1) // self.max_concurrent)
+
+    # number of running and waiting jobs
+    def status(self):
+        with self.condition:
+            return {"running": len(self.running),
+                    "running_large": len([t for t in self.running if t.large]),
+                    "waiting": len(self.waiting),
+                    "max_concurrent": self.max_concurrent,
+                    "max_large": self.max_large,
+                    "large_poses": self.large_poses,
+                    "large_max_wait": self.large_max_wait,
+                    "max_poses": self.max_poses}
+
+# one scheduler per server process, shared by all sessions
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+    return _scheduler
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# PIAWEB - SHARDED PDB CODE ANALYSIS
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+# A list of PDB codes is split into consecutive shards that are analyzed independently, e.g. on different nodes.
+# Every shard runs PIA without normalization and writes a compact partial result with the interactions of its
+# complexes and PIA's raw interaction counts. The reduce step merges all partials of a list, e.g.:
+#
+#   python -m scripts.shards map --codes codes.txt --shard 3/8 --output partial_3.json.gz
+#   python -m scripts.shards reduce partial_*.json.gz --output result
+#
+# writes result.csv, result.json and result.png like a single extract_codes run of the whole list. Counts are
+# additive: the raw counts and aggregates PIA computed for every shard are summed and, like PIA normalizes a run,
+# divided by the total number of structures. The merged result is a PIA result, so the png is PIA's own plot.
+# tests.py compares map/reduce with a single extract_codes run (needs PIA).
+
+import gzip
+import json
+import argparse
+from scripts.export import write_csv, write_json, interaction_table, structure_key
+
+PARTIAL_FORMAT = "piaweb-partial"
+PARTIAL_VERSION = 1
+
+# read PDB codes from a text file, codes are separated by commas, spaces or line breaks
+def read_codes(filename):
+    with open(filename, "r") as f:
+        return [code for code in f.read().replace(",", " ").split() if code != ""]
+
+# parse a shard given as "index/number of shards", shards are numbered starting from 1
+def parse_shard(shard):
+    index, nr_shards = [int(i) for i in shard.split("/")]
+    if nr_shards < 1 or index < 1 or index > nr_shards:
+        raise ValueError("Invalid shard " + shard + ", expected index/number of shards with 1 <= index <= number of shards!")
+    return index, nr_shards
+
+# consecutive slice of a list for a shard, the shards 1 to nr_shards cover the list in order
+def shard_slice(items, index, nr_shards):
+    return items[(index - 1) * len(items) // nr_shards:index * len(items) // nr_shards]
+
+# analyze one shard of a list of PDB codes and return its partial result
+def analyze_shard(list_of_codes, index = 1, nr_shards = 1):
+    from scripts.PIAWebBase import extract_codes
+
+    codes = shard_slice(list_of_codes, index, nr_shards)
+    partial = {"format": PARTIAL_FORMAT, "version": PARTIAL_VERSION, "shard": index, "nr_shards": nr_shards,
+               "codes": codes, "skipped": [], "nr_structures": len(codes), "frequencies": [], "result": {}, "complexes": {}}
+    if len(codes) > 0:
+        # raw counts are additive over shards, normalization needs the total number of structures
+        result, skipped = extract_codes(codes, normalize = False, return_skipped = True)
+        partial["skipped"] = skipped
+        partial["nr_structures"] = len(codes) - len(skipped)
+        partial["frequencies"] = [[key, result.i_frequencies[key]] for key in result.i_frequencies]
+        partial["result"] = result.result
+        partial["complexes"] = result.complexes
+
+    return partial
+
+# write a partial result as gzip compressed json
+def write_partial(partial, filename):
+    with gzip.open(filename, "wt", encoding = "utf-8") as f:
+        write_json(partial, f)
+    return filename
+
+# read a partial result, plain json files are accepted as well
+def read_partial(filename):
+    with open(filename, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    with (gzip.open(filename, "rt", encoding = "utf-8") if compressed else open(filename, "r", encoding = "utf-8")) as f:
+        partial = json.load(f)
+    if not isinstance(partial, dict) or partial.get("format") != PARTIAL_FORMAT:
+        raise ValueError(filename + " is not a partial result!")
+    if partial.get("version") != PARTIAL_VERSION:
+        raise ValueError("Unsupported version " + str(partial.get("version")) + " of partial result " + filename + "!")
+    return partial
+
+# entries of the analyzed structures in the result of a shard, other entries are aggregates over the shard
+def _structure_results(partial):
+    keys = [structure_key(partial["result"], structure) for structure in partial["complexes"]]
+    return [(key, partial["result"][key]) for key in keys if key is not None]
+
+# counts in aggregates are numbers but not booleans
+def _is_count(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+# add the aggregate entries PIA computed for two shards, counts are summed, nested entries are added per key and
+# lists are concatenated in shard order, anything else has to be the same for all shards
+def _add_aggregates(a, b, key):
+    if _is_count(a) and _is_count(b):
+        return a + b
+    if isinstance(a, dict) and isinstance(b, dict):
+        merged = dict(a)
+        for k, value in b.items():
+            merged[k] = _add_aggregates(merged[k], value, k) if k in merged else value
+        return merged
+    if isinstance(a, list) and isinstance(b, list):
+        return a + b
+    if a != b:
+        raise ValueError("Aggregate " + str(key) + " differs between shards and can't be merged!")
+    return a
+
+# normalize summed counts of an aggregate like PIA normalizes a run
+def _normalize_aggregate(aggregate, nr_structures):
+    if isinstance(aggregate, dict):
+        return {key: _normalize_aggregate(value, nr_structures) for key, value in aggregate.items()}
+    if _is_count(aggregate):
+        return aggregate / nr_structures
+    return aggregate
+
+# merge the partial results of all shards of a list, every shard has to be given exactly once, returns the merged
+# "i_frequencies", "result", "complexes" and "nr_structures"
+def merge_partials(partials, normalize = True):
+
+    if len(partials) == 0:
+        raise ValueError("No partial results to merge!")
+    nr_shards = partials[0]["nr_shards"]
+    shards = sorted([partial["shard"] for partial in partials])
+    if any([partial["nr_shards"] != nr_shards for partial in partials]):
+        raise ValueError("Partial results belong to different splits of the list of PDB codes!")
+    if shards != list(range(1, nr_shards + 1)):
+        missing = [str(i) for i in range(1, nr_shards + 1) if i not in shards]
+        duplicate = sorted(set([str(i) for i in shards if shards.count(i) > 1]))
+        raise ValueError("Can't merge partial results, missing shards: " + (", ".join(missing) or "none") +
+                         ", duplicate shards: " + (", ".join(duplicate) or "none") + "!")
+
+    partials = sorted(partials, key = lambda partial: partial["shard"])
+    nr_structures = sum([partial["nr_structures"] for partial in partials])
+    skipped = [code for partial in partials for code in partial.get("skipped", [])]
+    if len(skipped) > 0:
+        print("Warning: " + str(len(skipped)) + " PDB codes were skipped in the shards: " + ", ".join(skipped))
+    frequencies = {}
+    first_occurrence = {}
+    result = {}
+    aggregates = {}
+    complexes = {}
+    for partial in partials:
+        for key, value in partial["frequencies"]:
+            frequencies[key] = frequencies.get(key, 0) + value
+        for key in interaction_table(partial["result"], partial["complexes"])["interaction"]:
+            first_occurrence.setdefault(key, len(first_occurrence))
+        structure_results = _structure_results(partial)
+        for key, entry in structure_results:
+            if key in result:
+                raise ValueError("Structure " + str(key) + " is part of more than one shard!")
+            result[key] = entry
+        structure_keys = set([key for key, entry in structure_results])
+        for key, value in partial["result"].items():
+            if key not in structure_keys:
+                aggregates[key] = _add_aggregates(aggregates[key], value, key) if key in aggregates else value
+        complexes.update(partial["complexes"])
+
+    # most frequent interactions first, ties in order of first occurrence in the complexes
+    for key in frequencies:
+        first_occurrence.setdefault(key, len(first_occurrence))
+    i_frequencies = {}
+    for key in sorted(frequencies, key = lambda key: (-frequencies[key], first_occurrence[key])):
+        i_frequencies[key] = frequencies[key] / nr_structures if normalize and nr_structures > 0 else frequencies[key]
+    # aggregates follow the structure entries like in the result of a single run
+    for key, value in aggregates.items():
+        result[key] = _normalize_aggregate(value, nr_structures) if normalize and nr_structures > 0 else value
+
+    print("Merged " + str(len(partials)) + " partial results of " + str(nr_structures) + " structures.")
+
+    return {"i_frequencies": i_frequencies, "result": result, "complexes": complexes, "nr_structures": nr_structures}
+
+# PIA result of merged partials, plotting and all other methods are PIA's own
+def pia_result(merged):
+    from PIA.PIA import PIA
+
+    result = PIA.__new__(PIA)
+    result.i_frequencies = merged["i_frequencies"]
+    result.result = merged["result"]
+    # names of the complexes in result.result for the exports, like extract_codes
+    result.complexes = merged["complexes"]
+    return result
+
+# write csv, json and plot of a PIA result like the downloads of Workflow I
+def write_result(result, output_prefix):
+    with open(output_prefix + ".csv", "w", encoding = "utf-8", newline = "") as f:
+        write_csv(result.i_frequencies, f)
+    with open(output_prefix + ".json", "w", encoding = "utf-8") as f:
+        write_json(result.result, f)
+    import matplotlib.pyplot as plt
+    fig = result.plot("Results of PIA - Workflow I")
+    fig.savefig(output_prefix + ".png")
+    plt.close(fig)
+    return [output_prefix + ".csv", output_prefix + ".json", output_prefix + ".png"]
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Sharded analysis of a list of PDB codes.")
+    subparsers = parser.add_subparsers(dest = "command")
+    map_parser = subparsers.add_parser("map", help = "Analyze one shard of a list of PDB codes and write its partial result.")
+    map_parser.add_argument("--codes", required = True, help = "Text file with PDB codes separated by commas, spaces or line breaks.")
+    map_parser.add_argument("--shard", default = "1/1", help = "Shard to analyze as index/number of shards, e.g. 3/8 (default: 1/1).")
+    map_parser.add_argument("--output", required = True, help = "Filename of the partial result, e.g. partial_3.json.gz.")
+    reduce_parser = subparsers.add_parser("reduce", help = "Merge the partial results of all shards.")
+    reduce_parser.add_argument("partials", nargs = "+", help = "Partial results of all shards.")
+    reduce_parser.add_argument("--no-normalize", action = "store_true", help = "Report raw interaction counts instead of frequencies.")
+    reduce_parser.add_argument("--output", default = "result", help = "Prefix of the csv, json and png files (default: result).")
+    args = parser.parse_args(argv)
+
+    if args.command == "map":
+        try:
+            index, nr_shards = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        partial = analyze_shard(read_codes(args.codes), index, nr_shards)
+        write_partial(partial, args.output)
+        print("Wrote partial result of shard " + args.shard + " with " + str(partial["nr_structures"]) + " structures to " + args.output + ".")
+    elif args.command == "reduce":
+        result = pia_result(merge_partials([read_partial(filename) for filename in args.partials], normalize = not args.no_normalize))
+        for filename in write_result(result, args.output):
+            print("Wrote " + filename + ".")
+    else:
+        parser.print_help()
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
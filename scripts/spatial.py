@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# PIAWEB - SPATIAL INDEX OF HOST STRUCTURES
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+import os
+import numpy as np
+from scipy.spatial import cKDTree
+
+# maximum length of a covalent bond, atoms closer than this are treated as bonded
+BOND_LENGTH_MAX = 2.1
+
+# distance within which PLIP assigns host atoms to the binding site of a ligand, see plip.basic.config
+BS_DIST = 7.5
+
+# only heavy atoms are indexed, hydrogens are at most this far from their heavy atom
+HYDROGEN_MARGIN = 1.5
+
+# maximum distance of atoms that Open Babel might bond (sum of covalent radii + 0.45, metals included)
+BOND_PERCEPTION_MAX = 3.0
+
+# element of an atom record, "X" if it is unknown
+def _pdb_element(line):
+    element = line[76:78].strip().upper() if len(line) > 76 else ""
+    if element == "":
+        name = "".join([c for c in line[12:16] if c.isalpha()]).upper()
+        element = name[:1] if name[:1] in ["C", "N", "O", "S", "P"] else "X"
+    return element
+
+# read all atoms of a PDB file: coordinates, elements and residue of every atom
+def read_pdb_atoms(pdb_file):
+
+    coordinates = []
+    elements = []
+    residues = []
+    residue_index = {}
+    atom_residues = []
+    with open(pdb_file, "r") as f:
+        for line in f:
+            if line.startswith("ATOM") or line.startswith("HETATM"):
+                coordinates.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+                elements.append(_pdb_element(line))
+                residue = (line[17:20].strip(), line[21], line[22:27])
+                if residue not in residue_index:
+                    residue_index[residue] = len(residues)
+                    residues.append(residue)
+                atom_residues.append(residue_index[residue])
+
+    return {"coordinates": np.array(coordinates, dtype = float).reshape(-1, 3),
+            "elements": np.array(elements, dtype = str),
+            "residues": residues,
+            "atom_residues": np.array(atom_residues, dtype = int)}
+
+# kd-tree over the heavy atoms of a host structure, built once per host and shared by all poses
+class HostIndex:
+
+    def __init__(self, pdb_file):
+
+        atoms = read_pdb_atoms(pdb_file)
+        heavy = atoms["elements"] != "H"
+        self.coordinates = atoms["coordinates"][heavy]
+        self.elements = atoms["elements"][heavy]
+        self.residues = atoms["residues"]
+        self.atom_residues = atoms["atom_residues"][heavy]
+        self.tree = cKDTree(self.coordinates) if len(self.coordinates) > 0 else None
+
+    # indices of host atoms within radius of any of the given points, optionally only atoms in mask
+    def near(self, points, radius, mask = None):
+        if self.tree is None or len(points) == 0:
+            return np.empty(0, dtype = int)
+        hits = self.tree.query_ball_point(points, radius)
+        indices = np.unique(np.concatenate([np.array(h, dtype = int) for h in hits]))
+        if mask is not None:
+            indices = indices[mask[indices]]
+        return indices
+
+    # indices of residues with an atom within radius of any of the given points
+    def residues_near(self, points, radius):
+        return set(np.unique(self.atom_residues[self.near(points, radius)]).tolist())
+
+    # residues needed to analyze a ligand at the given coordinates: all residues with an atom in the binding
+    # site and two shells of residues bonded to them, so that bonds, hydrogens and aromaticity of the binding
+    # site atoms are perceived exactly as in the full structure
+    def pocket(self, points, bond_shells = 2):
+        residues = self.residues_near(points, BS_DIST + HYDROGEN_MARGIN)
+        for shell in range(bond_shells):
+            atoms = np.isin(self.atom_residues, list(residues))
+            residues |= self.residues_near(self.coordinates[atoms], BOND_PERCEPTION_MAX)
+        return residues
+
+# residue of an atom record as used by HostIndex
+def _pdb_residue(line):
+    return (line[17:20].strip(), line[21], line[22:27])
+
+# write a copy of a complex that only contains the ligand and the pocket around it, ligand atoms are all atoms
+# of residues that are not part of the host, returns False if the complex can't be cropped: if it contains no
+# ligand atoms, duplicate atom serials that make its CONECT records ambiguous or ligand atoms within bond length
+# of host atoms (clashing or covalent poses), bond perception might then propagate through the whole host
+def crop_complex(complex_file, host, output_file):
+
+    with open(complex_file, "r") as f:
+        lines = f.read().splitlines()
+
+    serials = [line[6:11] for line in lines if line.startswith("ATOM") or line.startswith("HETATM")]
+    if len(set(serials)) != len(serials):
+        return False
+
+    residue_index = {residue: i for i, residue in enumerate(host.residues)}
+    ligand = [(float(line[30:38]), float(line[38:46]), float(line[46:54])) for line in lines
+              if (line.startswith("ATOM") or line.startswith("HETATM")) and _pdb_residue(line) not in residue_index]
+    if len(ligand) == 0:
+        return False
+    ligand = np.array(ligand, dtype = float)
+    if len(host.near(ligand, BOND_LENGTH_MAX)) > 0:
+        return False
+    pocket = host.pocket(ligand)
+
+    kept = set()
+    cropped = []
+    for line in lines:
+        if line.startswith("ATOM") or line.startswith("HETATM"):
+            residue = residue_index.get(_pdb_residue(line))
+            if residue is not None and residue not in pocket:
+                continue
+            kept.add(line[6:11].strip())
+        elif line.startswith("ANISOU"):
+            if line[6:11].strip() not in kept:
+                continue
+        elif line.startswith("CONECT"):
+            serials = [line[k:k + 5].strip() for k in range(6, min(len(line), 31), 5)]
+            partners = [serial for serial in serials[1:] if serial in kept]
+            if serials[0] not in kept or len(partners) == 0:
+                continue
+            line = "CONECT" + "".join([serial.rjust(5) for serial in [serials[0]] + partners])
+        cropped.append(line)
+
+    with open(output_file, "w") as f:
+        f.write("\n".join(cropped) + "\n")
+
+    return True
+
+# crop complex files in place to the ligand and the pocket around it, the host is indexed once and shared by all
+# complexes, complexes that can't be cropped are left as they are, returns the number of cropped complexes
+def crop_complexes(complex_files, host_file):
+
+    host = HostIndex(host_file)
+    nr_cropped = 0
+    for complex_file in complex_files:
+        if crop_complex(complex_file, host, complex_file + "_pocket.pdb"):
+            os.replace(complex_file + "_pocket.pdb", complex_file)
+            nr_cropped += 1
+
+    return nr_cropped
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+# PIAWEB - PERSISTENT RESULT STORE
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+import io
+import os
+import gzip
+import time
+import uuid
+import pickle
+import shutil
+import sqlite3
+import threading
+import pandas as pd
+from contextlib import closing
+from collections import OrderedDict
+
+# store location and lifetime of results in seconds, can be set via environment variables
+STORE_DIR = os.environ.get("PIAWEB_STORE_DIR", "piaweb_store")
+STORE_TTL = float(os.environ.get("PIAWEB_STORE_TTL", 24 * 60 * 60))
+
+# memory budgets in MB for results held in memory, in total and per session
+MEMORY_BUDGET = float(os.environ.get("PIAWEB_MEMORY_BUDGET_MB", 512)) * 1024 * 1024
+SESSION_BUDGET = float(os.environ.get("PIAWEB_SESSION_BUDGET_MB", 64)) * 1024 * 1024
+
+# minimum number of seconds between two expiry runs
+EXPIRY_INTERVAL = 60
+
+# results are kept as blobs on disk and indexed in sqlite, the session only holds result ids
+# every result is written to disk before it is indexed, recently used results are additionally cached
+# in memory until the memory budget is exceeded, then the least recently used ones are evicted
+# tables are cached parsed, so that reruns of a result viewer (paging, sorting, filtering) don't parse them again
+class ResultStore:
+
+    def __init__(self, directory = STORE_DIR, ttl = STORE_TTL, memory_budget = MEMORY_BUDGET, session_budget = SESSION_BUDGET):
+        self.directory = directory
+        self.blob_directory = os.path.join(directory, "blobs")
+        self.database = os.path.join(directory, "results.sqlite")
+        self.ttl = ttl
+        self.memory_budget = memory_budget
+        self.session_budget = session_budget
+        self.memory = OrderedDict()
+        self.memory_usage = {}
+        self.last_expiry = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.blob_directory, exist_ok = True)
+        self.__execute("CREATE TABLE IF NOT EXISTS results (id TEXT PRIMARY KEY, kind TEXT, size INTEGER, created REAL, expires REAL, session TEXT)")
+        # stores created before per session accounting lack the session column
+        columns = [row[1] for row in self.__execute("PRAGMA table_info(results)")]
+        if "session" not in columns:
+            self.__execute("ALTER TABLE results ADD COLUMN session TEXT")
+        # earlier versions only wrote results to disk when they were spilled, those results were lost on restart
+        for row in self.__execute("SELECT id FROM results"):
+            if not os.path.isfile(self.__blob_path(row[0])):
+                self.__execute("DELETE FROM results WHERE id = ?", (row[0],))
+
+    # run a single statement in its own connection, sqlite connections can't be shared between script threads
+    def __execute(self, statement, parameters = ()):
+        with closing(sqlite3.connect(self.database, timeout = 30)) as con:
+            with con:
+                rows = con.execute(statement, parameters).fetchall()
+        return rows
+
+    def __blob_path(self, result_id):
+        return os.path.join(self.blob_directory, result_id)
+
+    # register a result in the index
+    def __register(self, result_id, kind, size, ttl = None, session = None):
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        self.__execute("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)", (result_id, kind, size, now, now + ttl, session))
+        self.expire()
+        return result_id
+
+    # write a blob via a temporary file, so that a crash never leaves a partial blob behind
+    def __write_blob(self, result_id, data):
+        path = self.__blob_path(result_id)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    # drop a result from the memory cache, it is still on disk, lock has to be held by the caller
+    def __evict(self, key):
+        value, session, size = self.memory.pop(key)
+        self.memory_usage[session] -= size
+        if self.memory_usage[session] <= 0:
+            del self.memory_usage[session]
+
+    # cache a result in memory and evict least recently used results until session and total memory usage are
+    # within budget, eviction only releases memory and never touches the disk, raw results are cached by their
+    # result id and parsed tables by ("table", result id)
+    def __cache(self, key, value, session, size):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return
+            self.memory[key] = (value, session, size)
+            self.memory_usage[session] = self.memory_usage.get(session, 0) + size
+            for cached_key in list(self.memory.keys()):
+                if self.memory_usage.get(session, 0) <= self.session_budget:
+                    break
+                if self.memory[cached_key][1] == session:
+                    self.__evict(cached_key)
+            while len(self.memory) > 0 and sum(self.memory_usage.values()) > self.memory_budget:
+                self.__evict(next(iter(self.memory)))
+
+    # store raw bytes and return the result id
+    def put_bytes(self, data, kind = "bytes", ttl = None, session = None):
+        result_id = uuid.uuid4().hex
+        self.__write_blob(result_id, data)
+        self.__register(result_id, kind, len(data), ttl, session)
+        self.__cache(result_id, data, session, len(data))
+        return result_id
+
+    # store a string
+    def put_text(self, text, ttl = None, session = None):
+        return self.put_bytes(text.encode("utf-8"), kind = "text", ttl = ttl, session = session)
+
+    # store a pandas dataframe as gzip compressed pickle, unlike csv this keeps the dtypes of all columns, e.g.
+    # ligand names like "00123" or "NA" stay strings
+    def put_table(self, dataframe, ttl = None, session = None):
+        data = gzip.compress(pickle.dumps(dataframe, protocol = 4))
+        return self.put_bytes(data, kind = "table", ttl = ttl, session = session)
+
+    # move an existing file into the store, files are never loaded into memory
+    def put_file(self, path, kind = "bytes", ttl = None, session = None):
+        result_id = uuid.uuid4().hex
+        shutil.move(path, self.__blob_path(result_id))
+        return self.__register(result_id, kind, os.path.getsize(self.__blob_path(result_id)), ttl, session)
+
+    # write a result directly to disk with the given function that takes a file handle,
+    # used for large exports that should not be built in memory first, the blob is written via a temporary
+    # file like in __write_blob and the temporary file is removed if the function fails
+    def put_stream(self, write_function, kind = "bytes", binary = False, ttl = None, session = None):
+        result_id = uuid.uuid4().hex
+        path = self.__blob_path(result_id)
+        try:
+            if binary:
+                with open(path + ".tmp", "wb") as f:
+                    write_function(f)
+            else:
+                with open(path + ".tmp", "w", encoding = "utf-8", newline = "") as f:
+                    write_function(f)
+            os.replace(path + ".tmp", path)
+        except BaseException:
+            if os.path.isfile(path + ".tmp"):
+                os.remove(path + ".tmp")
+            raise
+        return self.__register(result_id, kind, os.path.getsize(path), ttl, session)
+
+    # check if a result exists and has not expired yet
+    def exists(self, result_id):
+        rows = self.__execute("SELECT expires FROM results WHERE id = ?", (result_id,))
+        if len(rows) == 0 or rows[0][0] <= time.time():
+            return False
+        return os.path.isfile(self.__blob_path(result_id))
+
+    # check if all results of a dict or list of result ids exist
+    def exists_all(self, result_ids):
+        if isinstance(result_ids, dict):
+            result_ids = result_ids.values()
+        return all([self.exists(result_id) for result_id in result_ids])
+
+    # return stored bytes or None if the result does not exist (anymore), results read from disk are cached
+    def get_bytes(self, result_id):
+        rows = self.__execute("SELECT expires, session FROM results WHERE id = ?", (result_id,))
+        if len(rows) == 0 or rows[0][0] <= time.time():
+            return None
+        with self.lock:
+            if result_id in self.memory:
+                self.memory.move_to_end(result_id)
+                return self.memory[result_id][0]
+        try:
+            with open(self.__blob_path(result_id), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self.__cache(result_id, data, rows[0][1], len(data))
+        return data
+
+    def get_text(self, result_id):
+        data = self.get_bytes(result_id)
+        return data.decode("utf-8") if data is not None else None
+
+    # return a stored table or None, the parsed table is cached in place of the stored bytes and counts against
+    # the memory budgets with its in-memory size, it is shared by all readers and must not be modified
+    # tables are only ever pickled by the store itself, tables of earlier versions are gzip compressed csv
+    def get_table(self, result_id):
+        rows = self.__execute("SELECT expires, session FROM results WHERE id = ?", (result_id,))
+        if len(rows) == 0 or rows[0][0] <= time.time():
+            return None
+        with self.lock:
+            if ("table", result_id) in self.memory:
+                self.memory.move_to_end(("table", result_id))
+                return self.memory[("table", result_id)][0]
+        data = self.get_bytes(result_id)
+        if data is None:
+            return None
+        data = gzip.decompress(data)
+        dataframe = pickle.loads(data) if data[:1] == b"\x80" else pd.read_csv(io.BytesIO(data), index_col = 0)
+        with self.lock:
+            if result_id in self.memory:
+                self.__evict(result_id)
+        self.__cache(("table", result_id), dataframe, rows[0][1], int(dataframe.memory_usage(index = True, deep = True).sum()))
+        return dataframe
+
+    # remove a result
+    def delete(self, result_id):
+        self.__execute("DELETE FROM results WHERE id = ?", (result_id,))
+        with self.lock:
+            for key in [result_id, ("table", result_id)]:
+                if key in self.memory:
+                    self.__evict(key)
+        if os.path.isfile(self.__blob_path(result_id)):
+            os.remove(self.__blob_path(result_id))
+
+    # remove all expired results, runs at most every EXPIRY_INTERVAL seconds unless forced
+    def expire(self, force = False):
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_expiry < EXPIRY_INTERVAL:
+                return 0
+            self.last_expiry = now
+        expired = self.__execute("SELECT id FROM results WHERE expires <= ?", (now,))
+        for row in expired:
+            self.delete(row[0])
+        return len(expired)
+
+    # memory (cache) and disk usage in bytes, in total and per session
+    def usage(self):
+        sessions = {}
+        with self.lock:
+            for key, (value, session, size) in self.memory.items():
+                sessions.setdefault(session, {"memory": 0, "disk": 0, "results": 0})
+                sessions[session]["memory"] += size
+        for result_id, size, session in self.__execute("SELECT id, size, session FROM results WHERE expires > ?", (time.time(),)):
+            sessions.setdefault(session, {"memory": 0, "disk": 0, "results": 0})
+            sessions[session]["results"] += 1
+            sessions[session]["disk"] += size
+        return {"memory": sum([s["memory"] for s in sessions.values()]),
+                "disk": sum([s["disk"] for s in sessions.values()]),
+                "results": sum([s["results"] for s in sessions.values()]),
+                "memory_budget": self.memory_budget,
+                "session_budget": self.session_budget,
+                "sessions": sessions}
+
+# one store per server process, shared by all sessions
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ResultStore()
+    return _store
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# PIAWEB - PARALLEL SPLIT AND PARAMETER SWEEP FOR PIASCORE
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+# The sweep trains PIA models (PIAModel.train) several times for every combination of test and validation size and
+# summarizes the test statistics of every strategy. Features, cutoffs, labels and metrics are PIA's own, every run
+# is a training of Workflow II with the given sizes. PIA extracts the interactions in every training and
+# can't train on interactions that were extracted before, so the runs don't share the extraction, they are trained
+# in parallel worker processes instead.
+
+import os
+import itertools
+import multiprocessing
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scripts.scheduler import get_scheduler
+
+STRATEGIES = ["+", "++", "+-", "++--"]
+
+METRICS = ["ACC", "FPR", "AUC", "Ya", "EF", "REF"]
+
+# train a PIA model on one random split and return the cutoff and test statistics of every strategy
+def train_run(task):
+    from PIA.PIAModel import PIAModel
+
+    run, files, options, prefix = task
+    model = PIAModel()
+    try:
+        model.train(*files, test_size = run["test_size"], val_size = run["val_size"], plot_prefix = prefix,
+                    keep_files = False, tmp_dir_name = prefix + "_structures", **options)
+    finally:
+        # comparison plots are not part of the sweep
+        for partition in ["train", "val", "test"]:
+            if os.path.exists(prefix + "_comparison_" + partition + ".png"):
+                os.remove(prefix + "_comparison_" + partition + ".png")
+
+    result = {}
+    for strategy in STRATEGIES:
+        s, cutoff = model.change_strategy(strategy)
+        result[strategy] = dict([(metric, model.statistics["TEST"][strategy][metric]) for metric in METRICS], cutoff = cutoff)
+
+    return run, result
+
+# all runs: "repeats" trainings for every combination of test and val size
+def generate_runs(test_sizes = [0.3], val_sizes = [0.3], repeats = 10):
+    return [{"test_size": test_size, "val_size": val_size, "split": r} for test_size, val_size, r in itertools.product(test_sizes, val_sizes, range(repeats))]
+
+# train all runs in parallel and summarize mean and variance of the metrics per strategy and split configuration,
+# by default a sweep uses the share of cpus of one scheduler slot, worker processes are spawned instead of forked
+# because forking the multithreaded server process is not safe
+def sweep(pdb_file, sdf_file_1, sdf_file_2 = None, poses = "best", labels_by = "name", condition_operator = ">=", condition_value = 1000,
+          test_sizes = [0.3], val_sizes = [0.3], repeats = 10, n_jobs = None, tmp_prefix = "piaweb_sweep_tmp"):
+
+    options = {"poses": poses, "labels_by": labels_by, "condition_operator": condition_operator, "condition_value": condition_value}
+    runs = generate_runs(test_sizes, val_sizes, repeats)
+    tasks = [(run, (pdb_file, sdf_file_1, sdf_file_2), options, tmp_prefix + "_" + str(i)) for i, run in enumerate(runs)]
+    n_jobs = min(n_jobs if n_jobs is not None else get_scheduler().workers_per_job(), max(1, len(tasks)))
+
+    rows = []
+    def collect(results):
+        for run, result in results:
+            for strategy in STRATEGIES:
+                rows.append(dict(run, strategy = strategy, **result[strategy]))
+            print("Trained model " + str(len(rows) // len(STRATEGIES)) + " of " + str(len(tasks)) + ".")
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers = n_jobs, mp_context = multiprocessing.get_context("spawn")) as executor:
+            collect(executor.map(train_run, tasks))
+    else:
+        collect(map(train_run, tasks))
+
+    runs = pd.DataFrame(rows)
+    summary = runs.groupby(["strategy", "test_size", "val_size"], sort = False)[["ACC", "AUC", "EF", "REF"]].agg(["mean", "var"])
+    summary.columns = [metric + " " + stat for metric, stat in summary.columns]
+    summary["runs"] = runs.groupby(["strategy", "test_size", "val_size"], sort = False).size()
+
+    return {"summary": summary.reset_index(), "runs": runs}
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# PIAWEB - COMPRESSED UPLOADS
+# 2021 (c) Micha Johannes Birklbauer
+# https://github.com/michabirklbauer/
+# micha.birklbauer@gmail.com
+
+import gzip
+import time
+import shutil
+from zipfile import ZipFile
+from contextlib import contextmanager
+
+# file types accepted for SD files, gzip compressed files have to be SD files as well
+SDF_TYPES = ["sdf", "sdf.gz", "zip"]
+
+# size of the chunks that are decompressed and written at once
+CHUNK_SIZE = 1024 * 1024
+
+# compression of an uploaded file or filename from its extension: "gz", "zip" or None
+def compression(uploaded_file):
+    name = uploaded_file if isinstance(uploaded_file, str) else uploaded_file.name
+    extension = name.lower().split(".")[-1]
+    return extension if extension in ["gz", "zip"] else None
+
+# name of the uncompressed file, e.g. "ligands.sdf.gz" -> "ligands.sdf"
+def upload_name(uploaded_file, extension = ".sdf"):
+    name = uploaded_file.name
+    if compression(uploaded_file) != None:
+        name = name[:name.rfind(".")]
+    if not name.lower().endswith(extension):
+        name += extension
+    return name
+
+# open the content of an uploaded file as binary stream, .gz and .zip uploads are decompressed on the fly,
+# gzip compressed files and the single file of a zip archive have to have the given extension
+@contextmanager
+def open_upload(uploaded_file, extension = ".sdf"):
+
+    if compression(uploaded_file) == "gz" and not uploaded_file.name.lower()[:-3].endswith(extension):
+        raise ValueError(uploaded_file.name + " is not a compressed " + extension + " file!")
+    uploaded_file.seek(0)
+    try:
+        if compression(uploaded_file) == "gz":
+            with gzip.GzipFile(fileobj = uploaded_file, mode = "rb") as f:
+                yield f
+        elif compression(uploaded_file) == "zip":
+            with ZipFile(uploaded_file) as zf:
+                members = [m for m in zf.infolist() if not m.is_dir() and m.filename.lower().endswith(extension)]
+                if len(members) != 1:
+                    raise ValueError("ZIP archive " + uploaded_file.name + " has to contain exactly one " + extension + " file, found " + str(len(members)) + "!")
+                with zf.open(members[0]) as f:
+                    yield f
+        else:
+            yield uploaded_file
+    finally:
+        uploaded_file.seek(0)
+
+# write an uploaded file to disk, compressed uploads are decompressed as a stream without an in-memory copy
+def write_upload(uploaded_file, filename, extension = ".sdf"):
+
+    start = time.time()
+    with open_upload(uploaded_file, extension) as source:
+        with open(filename, "wb") as f:
+            shutil.copyfileobj(source, f, CHUNK_SIZE)
+            written = f.tell()
+    elapsed = max(time.time() - start, 1e-6)
+
+    if compression(uploaded_file) != None:
+        print("Decompressed " + uploaded_file.name + ": " + _megabytes(len(uploaded_file.getbuffer())) + " uploaded, " + _megabytes(written) +
+              " written in " + str(round(elapsed, 2)) + " s (" + _megabytes(written / elapsed) + "/s).")
+    else:
+        print("Received " + uploaded_file.name + ": " + _megabytes(written) + " written in " + str(round(elapsed, 2)) + " s (" + _megabytes(written / elapsed) + "/s).")
+
+    return filename
+
+def _megabytes(nr_bytes):
+    return str(round(nr_bytes / (1024 * 1024), 2)) + " MB"
@@ -13,8 +13,9 @@
 #####################################################
 """
 
+import os
 import streamlit as st
-from scripts import PIAWebBase, PIAWebScore, PIAWebPredict
+from scripts import PIAWebBase, PIAWebScore, PIAWebPredict, PIAWebAdmin
 
 # main page
 def main():
@@ -41,6 +42,10 @@ def main():
 
     pages = ("PIA: Extract Interactions", "PIAScore: Score Complexes", "PIAPredict: Predict Complexes")
 
+    # server status page is only shown if enabled by the admin
+    if os.environ.get("PIAWEB_ADMIN_PAGE", "0") == "1":
+        pages = pages + ("PIAAdmin: Server Status",)
+
     title = st.sidebar.title("PIA - Protein Interaction Analyzer")
 
     logo = st.sidebar.image("img/pmu_logo.jpg", caption = "PIA was developed in cooperation with the Institute of Pharmacy of the Paracelsus Medical Private University Salzburg.")
@@ -69,6 +74,8 @@ def main():
         PIAWebScore.main()
     elif page == "PIAPredict: Predict Complexes":
         PIAWebPredict.main()
+    elif page == "PIAAdmin: Server Status":
+        PIAWebAdmin.main()
     else:
         PIAWebBase.main()
 
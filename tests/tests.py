@@ -5,7 +5,712 @@
 # https://github.com/t0xic-m/
 # micha.birklbauer@gmail.com
 
+# Tests of the modules that work without PIA and streamlit, tests that need numpy, pandas and co. are skipped
+# if those are not installed (e.g. in gh actions).
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 def test_sample():
     # tests to be implemented
     # skipped -> would need to install all deps in gh actions!
     assert 1 == 1
+
+# result store
+
+def _store(directory, **kwargs):
+    pytest.importorskip("pandas")
+    from scripts.store import ResultStore
+    return ResultStore(directory = str(directory), **kwargs)
+
+# results of all kinds persist across a restart of the server
+def test_store_persistence(tmp_path):
+    store = _store(tmp_path)
+    text_id = store.put_text("text", session = "a")
+    stream_id = store.put_stream(lambda f: f.write("stream"), kind = "text")
+    with open(str(tmp_path / "upload.zip"), "wb") as f:
+        f.write(b"zip")
+    file_id = store.put_file(str(tmp_path / "upload.zip"), kind = "zip")
+    restarted = _store(tmp_path)
+    assert restarted.get_text(text_id) == "text"
+    assert restarted.get_text(stream_id) == "stream"
+    assert restarted.get_bytes(file_id) == b"zip"
+    assert restarted.exists_all({"text": text_id, "stream": stream_id, "file": file_id})
+    assert not restarted.exists("unknown")
+    assert restarted.get_bytes("unknown") is None
+
+# results are gone after their lifetime, expire removes their rows and blobs
+def test_store_ttl(tmp_path):
+    import time
+    store = _store(tmp_path, ttl = 60)
+    short_id = store.put_text("short", ttl = 0.05)
+    long_id = store.put_text("long")
+    assert store.exists(short_id)
+    time.sleep(0.1)
+    assert not store.exists(short_id)
+    assert store.get_text(short_id) is None
+    assert store.expire(force = True) == 1
+    assert not os.path.isfile(os.path.join(str(tmp_path), "blobs", short_id))
+    assert store.get_text(long_id) == "long"
+    assert store.usage()["results"] == 1
+
+# results are written to disk right away, the memory cache is lost on restart but the results are not
+def test_store_write_through(tmp_path):
+    store = _store(tmp_path)
+    result_id = store.put_bytes(b"result", session = "a")
+    assert store.usage()["memory"] == len(b"result")
+    restarted = _store(tmp_path)
+    assert restarted.exists(result_id)
+    assert restarted.get_bytes(result_id) == b"result"
+
+# evicting results from the memory cache keeps them readable from disk
+def test_store_eviction(tmp_path):
+    store = _store(tmp_path, memory_budget = 10, session_budget = 6)
+    ids = [store.put_bytes(bytes([i]) * 4, session = "a") for i in range(3)]
+    usage = store.usage()
+    assert usage["memory"] <= 6
+    assert usage["disk"] == 12
+    assert [store.get_bytes(result_id) for result_id in ids] == [bytes([i]) * 4 for i in range(3)]
+    assert store.usage()["memory"] <= 6
+
+# rows of results whose blob is missing, e.g. memory only results of earlier versions, are dropped on startup
+def test_store_drops_missing_blobs(tmp_path):
+    store = _store(tmp_path)
+    result_id = store.put_text("result")
+    os.remove(os.path.join(str(tmp_path), "blobs", result_id))
+    restarted = _store(tmp_path)
+    assert not restarted.exists(result_id)
+    assert restarted.usage()["results"] == 0
+
+# parsed tables are cached instead of their bytes and count against the memory budgets with their size in memory
+def test_store_table_cache(tmp_path):
+    pd = pytest.importorskip("pandas")
+    table = pd.DataFrame({"NAME": ["ligand_" + str(i) for i in range(1000)], "SCORE": list(range(1000))})
+    size = int(table.memory_usage(index = True, deep = True).sum())
+    store = _store(tmp_path, memory_budget = 3 * size, session_budget = 3 * size)
+    result_id = store.put_table(table, session = "a")
+    assert store.get_table(result_id) is store.get_table(result_id)
+    assert store.usage()["sessions"]["a"]["memory"] == size
+    small = _store(tmp_path, memory_budget = size // 2, session_budget = size // 2)
+    assert small.get_table(result_id).equals(table)
+    assert small.usage()["memory"] == 0
+    store.delete(result_id)
+    assert store.usage()["memory"] == 0 and store.get_table(result_id) is None
+
+# a failing export leaves neither a blob nor a temporary file behind
+def test_store_failed_stream(tmp_path):
+    store = _store(tmp_path)
+    def write_function(f):
+        f.write("partial")
+        raise ValueError("export failed")
+    with pytest.raises(ValueError):
+        store.put_stream(write_function, kind = "text")
+    assert os.listdir(os.path.join(str(tmp_path), "blobs")) == []
+    assert store.usage()["results"] == 0
+
+# tables keep the values and dtypes of all columns, names that look like numbers or missing values stay strings
+def test_store_table_round_trip(tmp_path):
+    pd = pytest.importorskip("pandas")
+    store = _store(tmp_path)
+    table = pd.DataFrame({"NAME": ["00123", "4e5", "NA"], "SCORE": [3, -1, 0], "PREDICTION": ["active", "inactive", "inactive"]},
+                         index = [5, 7, 9])
+    result_id = store.put_table(table)
+    assert _store(tmp_path).get_table(result_id).equals(table)
+    assert list(store.get_table(result_id)["NAME"]) == ["00123", "4e5", "NA"]
+
+# exports
+
+# only entries of analyzed structures are exported, aggregates of the result are ignored
+def test_interaction_table():
+    from scripts.export import interaction_table
+    result = {"tmp/1abc.pdb": {"LIG:A:1": {"interactions": ["Hydrogen_Bond:TYR-1A", "Hydrogen_Bond:TYR-1A", "Salt_Bridge:ASP52AB"]}},
+              "2xyz.pdb": {"LIG:B:2": {"Hydrophobic_Interaction:LEU12A": 2}},
+              "i_frequencies": {"Hydrogen_Bond:TYR-1A": 1.0, "Salt_Bridge:ASP52AB": 0.5}}
+    table = interaction_table(result, {"1abc.pdb": "1ABC", "2xyz.pdb": "2XYZ", "3def.pdb": "3DEF"})
+    rows = sorted(zip(table["complex"], table["interaction"], table["count"]))
+    assert rows == [("1ABC", "Hydrogen_Bond:TYR-1A", 2), ("1ABC", "Salt_Bridge:ASP52AB", 1), ("2XYZ", "Hydrophobic_Interaction:LEU12A", 2)]
+
+# interactions of a single structure are counted from the entries of all its ligands
+def test_structure_interactions():
+    from scripts.export import structure_interactions
+    result = {"tmp/1abc.pdb": {"LIG:A:1": {"interactions": ["Hydrogen_Bond:TYR-1A", "Hydrogen_Bond:TYR-1A"]}},
+              "i_frequencies": {"Hydrogen_Bond:TYR-1A": 1.0}}
+    assert structure_interactions(result, "1abc.pdb") == {"Hydrogen_Bond:TYR-1A": 2}
+    assert structure_interactions(result, "2xyz.pdb") is None
+
+def test_write_csv_json():
+    import io
+    import json
+    from scripts.export import write_csv, write_json
+    with io.StringIO() as f:
+        write_csv({"Hydrogen_Bond:TYR1A": 0.5, "Pi-Stacking:PHE2A": 1}, f)
+        assert f.getvalue() == "Interaction,Frequency\nHydrogen_Bond:TYR1A,0.5\nPi-Stacking:PHE2A,1\n"
+    with io.StringIO() as f:
+        write_json({"a": [1, 2, {"b": None}]}, f)
+        assert json.loads(f.getvalue()) == {"a": [1, 2, {"b": None}]}
+
+def test_write_parquet():
+    import io
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+    from scripts.export import write_parquet, columnar_export_available
+    assert columnar_export_available()
+    table = {"complex": ["1ABC"], "interaction": ["Hydrogen_Bond:TYR-1A"], "count": [2]}
+    with io.BytesIO() as f:
+        write_parquet(table, f)
+        assert pq.read_table(io.BytesIO(f.getvalue())).to_pydict() == table
+
+# prediction results, the page module needs streamlit and PIA
+
+def test_filter_results():
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("streamlit")
+    pytest.importorskip("PIA")
+    from scripts.PIAWebPredict import filter_results, summarize_predictions
+    dataframe = pd.DataFrame({"NAME": ["lig_" + str(i) for i in range(120)], "SCORE": [i % 7 for i in range(120)],
+                              "PREDICTION": ["active" if i % 3 == 0 else "inactive" for i in range(120)]})
+    assert summarize_predictions(dataframe) == {"PREDICTION": {"active": 40, "inactive": 80}}
+    page, nr_results, nr_pages = filter_results(dataframe, prediction = "active", sort_by = "SCORE", ascending = False, page = 2, page_size = 25)
+    assert (nr_results, nr_pages, len(page)) == (40, 2, 15)
+    assert list(page["SCORE"]) == sorted(page["SCORE"], reverse = True)
+    page, nr_results, nr_pages = filter_results(dataframe, search = "LIG_11", page = 5)
+    assert nr_results == 11 and nr_pages == 1 and set(page["NAME"]) == set(["lig_11"] + ["lig_11" + str(i) for i in range(10)])
+
+# charts
+
+# frequency charts keep the order of the result and roc charts contain the curve in order plus the diagonal
+def test_charts():
+    import json
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("pandas")
+    from scripts.charts import frequencies_to_json, frequency_chart, roc_to_dict, roc_chart
+    frequencies = {"Hydrogen_Bond:TYR1A": np.float64(0.75), "Pi-Stacking:PHE2A": 1, "Salt_Bridge:ASP3A": 0.25}
+    data, spec = frequency_chart(frequencies_to_json(frequencies), "Frequencies")
+    assert list(data["interaction"]) == list(frequencies.keys())
+    assert list(data["frequency"]) == [0.75, 1.0, 0.25]
+    assert spec["title"] == "Frequencies" and spec["encoding"]["x"]["sort"] is None
+    assert "title" not in frequency_chart(frequencies_to_json({}))[1]
+    roc = roc_to_dict(np.array([0.0, 0.5, 1.0]), np.array([0.0, 0.75, 1.0]))
+    assert json.loads(json.dumps(roc)) == {"fpr": [0.0, 0.5, 1.0], "tpr": [0.0, 0.75, 1.0]}
+    data, spec = roc_chart(roc, "ROC")
+    assert list(data["fpr"]) == roc["fpr"] and list(data["tpr"]) == roc["tpr"] and list(data["order"]) == [0, 1, 2]
+    assert spec["title"] == "ROC" and spec["layer"][1]["data"]["values"] == [{"fpr": 0, "tpr": 0}, {"fpr": 1, "tpr": 1}]
+
+# identical jobs
+
+def _registry(**kwargs):
+    pytest.importorskip("pandas")
+    from scripts.jobs import JobRegistry
+    return JobRegistry(**kwargs)
+
+# a job started while an identical one is running waits for it instead of computing again
+def test_jobs_deduplication():
+    import time
+    import threading
+    registry = _registry()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    def job():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "result"
+    results = []
+    leader = threading.Thread(target = lambda: results.append(registry.run("key", job)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target = lambda: results.append(registry.run("key", job)))
+    follower.start()
+    # the result is the same if the follower only arrives after the job finished
+    time.sleep(0.2)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert results == ["result", "result"]
+    assert len(calls) == 1
+    assert registry.run("key", job) == "result"
+    assert len(calls) == 1
+    assert registry.run("key", job, is_valid = lambda result: False) == "result"
+    assert len(calls) == 2
+
+# errors of a job are passed on to waiting jobs, a stopped job lets a waiting job take over
+def test_jobs_errors():
+    import time
+    import threading
+    class Stop(BaseException):
+        pass
+    registry = _registry()
+    with pytest.raises(ValueError):
+        registry.run("error", lambda: int("x"))
+    assert "error" not in registry.running and "error" not in registry.completed
+    started = threading.Event()
+    release = threading.Event()
+    def stopped():
+        started.set()
+        release.wait(5)
+        raise Stop()
+    errors = []
+    def leader_run():
+        try:
+            registry.run("key", stopped)
+        except Stop:
+            errors.append("stop")
+    results = []
+    leader = threading.Thread(target = leader_run)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target = lambda: results.append(registry.run("key", lambda: "result")))
+    follower.start()
+    time.sleep(0.2)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert errors == ["stop"]
+    assert results == ["result"]
+
+# the validity of a completed result is checked without holding the lock of the registry
+def test_jobs_validity_check_unlocked():
+    registry = _registry()
+    registry.run("key", lambda: "result")
+    def is_valid(result):
+        assert registry.lock.acquire(blocking = False)
+        registry.lock.release()
+        return True
+    assert registry.run("key", lambda: "other", is_valid = is_valid) == "result"
+
+# jobs run in a slot of the scheduler, the size of a job is only counted if it has to be computed
+def test_run_job():
+    from scripts.scheduler import Scheduler, JobRejected
+    from scripts.jobs import run_job
+    registry = _registry()
+    scheduler = Scheduler(max_concurrent = 1, max_poses = 10)
+    counted = []
+    def count():
+        counted.append(1)
+        return 5
+    def job():
+        assert scheduler.status()["running"] == 1
+        return "result"
+    assert run_job("key", "user", count, job, registry = registry, scheduler = scheduler) == "result"
+    assert run_job("key", "user", count, job, registry = registry, scheduler = scheduler) == "result"
+    assert len(counted) == 1 and scheduler.status()["running"] == 0
+    with pytest.raises(JobRejected):
+        run_job("large", "user", lambda: 11, job, registry = registry, scheduler = scheduler)
+
+# uploads
+
+# uploaded file with a name like the files of st.file_uploader
+def _upload(name, data):
+    import io
+    uploaded_file = io.BytesIO(data)
+    uploaded_file.name = name
+    return uploaded_file
+
+# compressed uploads are written decompressed, zip archives have to contain exactly one SD file
+def test_write_upload(tmp_path):
+    import io
+    import gzip
+    from zipfile import ZipFile
+    from scripts.uploads import write_upload, open_upload, upload_name
+    content = b"ligand\n$$$$\n" * 1000
+    with io.BytesIO() as buffer:
+        with ZipFile(buffer, "w") as zf:
+            zf.writestr("docs/readme.txt", b"readme")
+            zf.writestr("docs/ligands.SDF", content)
+        archive = buffer.getvalue()
+    uploads = [_upload("ligands.sdf", content), _upload("ligands.sdf.gz", gzip.compress(content)), _upload("Ligands.Sdf.GZ", gzip.compress(content)),
+               _upload("ligands.zip", archive), _upload("ligands", content)]
+    assert [upload_name(u) for u in uploads] == ["ligands.sdf", "ligands.sdf", "Ligands.Sdf", "ligands.sdf", "ligands.sdf"]
+    for i, uploaded_file in enumerate(uploads):
+        filename = write_upload(uploaded_file, str(tmp_path / (str(i) + "_" + upload_name(uploaded_file))))
+        with open(filename, "rb") as f:
+            assert f.read() == content
+        with open_upload(uploaded_file) as f:
+            assert f.read() == content
+        assert uploaded_file.tell() == 0
+    with io.BytesIO() as buffer:
+        with ZipFile(buffer, "w") as zf:
+            zf.writestr("a.sdf", content)
+            zf.writestr("b.sdf", content)
+        two_members = buffer.getvalue()
+    with io.BytesIO() as buffer:
+        with ZipFile(buffer, "w") as zf:
+            zf.writestr("ligands.mol2", content)
+        no_members = buffer.getvalue()
+    for uploaded_file in [_upload("two.zip", two_members), _upload("none.zip", no_members), _upload("host.pdb.gz", gzip.compress(content))]:
+        with pytest.raises(ValueError):
+            write_upload(uploaded_file, str(tmp_path / "invalid.sdf"))
+
+# scheduler
+
+# poses are counted as lines starting with $$$$, also across the chunks of large uploads
+def test_count_poses():
+    import io
+    from scripts.scheduler import count_poses
+    from scripts.uploads import CHUNK_SIZE
+    pose = b"ligand\n\n\n  0  0  0  0  0  0  0  0  0  0999 V2000\nM  END\n$$$$\n"
+    assert count_poses(pose * 3) == 3
+    assert count_poses(b"$$$$\n" + pose) == 2
+    upload = io.BytesIO(pose * (3 * CHUNK_SIZE // len(pose) + 1))
+    upload.name = "ligands.sdf"
+    assert count_poses(upload) == 3 * CHUNK_SIZE // len(pose) + 1
+    assert count_poses(None) == 0
+
+# order in which the jobs given as (user, poses) start if a single slot frees up
+def _start_order(scheduler, jobs):
+    import time
+    import threading
+    started = []
+    threads = []
+    with scheduler.slot("running"):
+        for name, poses in jobs:
+            threads.append(threading.Thread(target = lambda name = name, poses = poses: scheduler.run(name, poses, lambda: started.append(name))))
+            threads[-1].start()
+            while scheduler.status()["waiting"] < len(threads):
+                time.sleep(0.01)
+        time.sleep(0.1)
+    for thread in threads:
+        thread.join(5)
+    return started
+
+# large jobs are deferred behind normal jobs, but only until they waited too long
+def test_scheduler_large_jobs():
+    from scripts.scheduler import Scheduler, JobRejected
+    jobs = [("large", 5000), ("normal", 10)]
+    assert _start_order(Scheduler(max_concurrent = 1, large_poses = 1000, large_max_wait = 60), jobs) == ["normal", "large"]
+    assert _start_order(Scheduler(max_concurrent = 1, large_poses = 1000, large_max_wait = 0.05), jobs) == ["large", "normal"]
+    with pytest.raises(JobRejected):
+        Scheduler(max_poses = 100).run("user", 101, lambda: None)
+
+# waiting jobs are served round robin over users
+def test_scheduler_round_robin():
+    from scripts.scheduler import Scheduler
+    jobs = [("a", 1), ("a", 1), ("a", 1), ("b", 1)]
+    assert _start_order(Scheduler(max_concurrent = 1), jobs) == ["a", "b", "a", "a"]
+
+# binary models
+
+_MODEL = {"positives": ["Hydrogen_Bond:TYR1A", "Pi-Stacking:PHE2A", "Hydrogen_Bond:TYR1A", "Salt_Bridge:ASP3Ä"],
+          "negatives": ["Hydrophobic_Interaction:LEU4A", "Pi-Stacking:PHE2A"],
+          "strategy": "best", "cutoff": 2,
+          "statistics": {"STRAT": {"best_strategy": "++--"}, "ACC": [0.5, None]}}
+
+# conversion from json to binary and back gives the same model and the same text
+def test_model_round_trip(tmp_path):
+    import json
+    pytest.importorskip("numpy")
+    from scripts.models import json_to_binary, binary_to_json, convert_model, is_binary_model, BinaryModel
+    text = json.dumps(_MODEL)
+    data = json_to_binary(text)
+    assert is_binary_model(data) and not is_binary_model(text.encode("utf-8"))
+    assert binary_to_json(data) == text
+    with open(str(tmp_path / "model.piam"), "w", encoding = "utf-8") as f:
+        f.write(text)
+    convert_model(str(tmp_path / "model.piam"), str(tmp_path / "model.piamb"))
+    convert_model(str(tmp_path / "model.piamb"), str(tmp_path / "model_2.piam"))
+    with open(str(tmp_path / "model_2.piam"), "r", encoding = "utf-8") as f:
+        assert json.load(f) == _MODEL
+    model = BinaryModel(str(tmp_path / "model.piamb"))
+    assert model.positives == _MODEL["positives"] and model.negatives == _MODEL["negatives"]
+    assert model.lookup("Pi-Stacking:PHE2A") >= 0 and model.lookup("Pi-Stacking:PHE3A") == -1
+    model.close()
+    with pytest.raises(ValueError):
+        BinaryModel(data = text.encode("utf-8"))
+
+# binary models score like scoring the profile against the positives and negatives of the model
+def test_model_score():
+    pytest.importorskip("numpy")
+    from scripts.models import encode_model, BinaryModel
+    from scripts.interactions import score_profile
+    model = BinaryModel(data = encode_model(_MODEL))
+    profiles = [{}, {"Hydrogen_Bond:TYR1A": 3, "Pi-Stacking:PHE2A": 1, "Unknown:ALA1A": 5},
+                {"Salt_Bridge:ASP3Ä": 2, "Hydrophobic_Interaction:LEU4A": 4, "Pi-Stacking:PHE2A": 2}]
+    for profile in profiles:
+        for strategy in ["+", "++", "+-", "++--"]:
+            assert model.score(profile, strategy) == score_profile(profile, _MODEL["positives"], _MODEL["negatives"], strategy)
+        assert model.score(profile) == model.score(profile, "++--")
+    assert model.score(profiles[1], "++") == 2 * 3 + 1
+
+# closing a memory-mapped model while its arrays are still referenced doesn't fail
+def test_model_close_with_views(tmp_path):
+    pytest.importorskip("numpy")
+    from scripts.models import encode_model, BinaryModel
+    with open(str(tmp_path / "model.piamb"), "wb") as f:
+        f.write(encode_model(_MODEL))
+    model = BinaryModel(str(tmp_path / "model.piamb"))
+    positive_ids = model.positive_ids
+    model.close()
+    assert list(positive_ids) == [0, 2, 0, 3]
+    model.close()
+
+# downloads
+
+# codes are downloaded from a local server, truncated downloads are downloaded again, mmCIF-only and missing
+# entries are skipped
+def test_download_structures(tmp_path, capsys):
+    import gzip
+    pytest.importorskip("pandas")
+    from scripts.loadtest import start_file_server
+    from scripts.downloads import download_structures
+    pdb = b"HEADER    TEST\nATOM      1  CA  ALA A   1       0.000   0.000   0.000  1.00  0.00           C\nEND\n"
+    class TruncatedOnce(dict):
+        def get(self, key, default = None):
+            data = dict.get(self, key, default)
+            if key == "4BAD.pdb.gz" and not hasattr(self, "served"):
+                self.served = True
+                return data[:len(data) // 2]
+            return data
+    files = TruncatedOnce({"1ABC.pdb.gz": gzip.compress(pdb), "2BIG.cif.gz": gzip.compress(b"data_2BIG\n"),
+                           "4BAD.pdb.gz": gzip.compress(pdb * 50), "5EMP.pdb.gz": gzip.compress(b"HEADER    EMPTY\nEND\n")})
+    server = start_file_server(files)
+    try:
+        url = "http://127.0.0.1:" + str(server.server_address[1]) + "/"
+        prefix = str(tmp_path / "structure_")
+        structures, skipped = download_structures(["1ABC", "2BIG", "3NOT.pdb", "4BAD", "5EMP"], prefix, url, retries = 1, retry_delay = 0)
+    finally:
+        server.shutdown()
+    assert structures == [prefix + "1ABC.pdb", prefix + "4BAD.pdb"]
+    assert skipped == ["2BIG", "3NOT", "5EMP"]
+    with open(prefix + "4BAD.pdb", "rb") as f:
+        assert f.read() == pdb * 50
+    assert sorted(os.listdir(str(tmp_path))) == ["structure_1ABC.pdb", "structure_4BAD.pdb"]
+    output = capsys.readouterr().out
+    assert "4BAD is corrupt" in output and "only available in mmCIF format" in output
+
+# sharded analysis
+
+# partial result of a shard of synthetic structures given as {code: interactions}, with an aggregate like PIA adds
+def _partial(structures, index, nr_shards):
+    from collections import Counter
+    from scripts.shards import PARTIAL_FORMAT, PARTIAL_VERSION
+    frequencies = Counter()
+    for interactions in structures.values():
+        frequencies.update(interactions)
+    return {"format": PARTIAL_FORMAT, "version": PARTIAL_VERSION, "shard": index, "nr_shards": nr_shards,
+            "codes": list(structures), "skipped": [], "nr_structures": len(structures),
+            "frequencies": [[key, value] for key, value in frequencies.items()],
+            "result": dict({"tmp/" + code + ".pdb": {"LIG": {"interactions": interactions}} for code, interactions in structures.items()},
+                           i_frequencies = dict(frequencies)),
+            "complexes": {"tmp/" + code + ".pdb": code for code in structures}}
+
+# merging the shards of a list gives the same csv and json as merging a single shard with the whole list
+def test_merge_partials(tmp_path):
+    import io
+    from scripts.shards import merge_partials, write_partial, read_partial, shard_slice
+    from scripts.export import write_csv
+    codes = ["1ABC", "2ABC", "3ABC", "4ABC", "5ABC"]
+    interactions = {"1ABC": ["Hydrogen_Bond:TYR1A", "Pi-Stacking:PHE2A"], "2ABC": ["Salt_Bridge:ASP3A"],
+                    "3ABC": ["Pi-Stacking:PHE2A", "Salt_Bridge:ASP3A", "Hydrogen_Bond:TYR1A", "Hydrogen_Bond:TYR1A"],
+                    "4ABC": [], "5ABC": ["Halogen_Bond:LEU4A"]}
+    single = merge_partials([_partial(interactions, 1, 1)])
+    shards = [_partial({code: interactions[code] for code in shard_slice(codes, i, 3)}, i, 3) for i in [3, 1, 2]]
+    merged = merge_partials([read_partial(write_partial(partial, str(tmp_path / ("partial_" + str(i) + ".json.gz")))) for i, partial in enumerate(shards)])
+    assert list(merged["i_frequencies"].items()) == list(single["i_frequencies"].items())
+    assert list(merged["i_frequencies"].items())[:2] == [("Hydrogen_Bond:TYR1A", 3 / 5), ("Pi-Stacking:PHE2A", 2 / 5)]
+    assert merged["result"] == single["result"] and len(merged["result"]) == 6
+    assert merged["result"]["i_frequencies"] == merged["i_frequencies"]
+    assert merged["nr_structures"] == 5 and merged["complexes"] == single["complexes"]
+    with io.StringIO() as a, io.StringIO() as b:
+        write_csv(merged["i_frequencies"], a)
+        write_csv(single["i_frequencies"], b)
+        assert a.getvalue() == b.getvalue()
+    assert merge_partials(shards, normalize = False)["i_frequencies"]["Hydrogen_Bond:TYR1A"] == 3
+
+# shards have to be complete, of the same split and must not overlap
+def test_merge_partials_errors():
+    from scripts.shards import merge_partials, parse_shard
+    with pytest.raises(ValueError):
+        merge_partials([_partial({"1ABC": []}, 1, 2)])
+    with pytest.raises(ValueError):
+        merge_partials([_partial({"1ABC": []}, 1, 2), _partial({"2ABC": []}, 2, 3)])
+    with pytest.raises(ValueError):
+        merge_partials([_partial({"1ABC": []}, 1, 2), _partial({"1ABC": []}, 2, 2)])
+    partials = [_partial({"1ABC": []}, 1, 2), _partial({"2ABC": []}, 2, 2)]
+    partials[0]["result"]["version"] = "1"
+    partials[1]["result"]["version"] = "2"
+    with pytest.raises(ValueError):
+        merge_partials(partials)
+    with pytest.raises(ValueError):
+        parse_shard("3/2")
+    assert parse_shard("2/8") == (2, 8)
+
+# map/reduce over shards of a list gives the same csv, json and plot as a single extract_codes run of the whole list,
+# the complexes are served by the local RCSB stand-in of the load test
+def test_shards_extract_codes(tmp_path, monkeypatch):
+    import gzip
+    _plip()
+    pytest.importorskip("streamlit")
+    pytest.importorskip("PIA")
+    from scripts.loadtest import start_file_server, synthetic_host, synthetic_complex
+    from scripts.export import interaction_table, structure_key
+    from scripts.shards import analyze_shard, merge_partials, pia_result, write_result
+    import scripts.PIAWebBase as base
+    host, centers = synthetic_host()
+    codes = ["SYN" + str(i + 1) for i in range(5)]
+    server = start_file_server({code + ".pdb.gz": gzip.compress(synthetic_complex(host, centers, 10 + i).encode("utf-8")) for i, code in enumerate(codes)})
+    monkeypatch.setattr(base, "RCSB_DOWNLOAD_URL", "http://127.0.0.1:" + str(server.server_address[1]) + "/")
+    monkeypatch.chdir(tmp_path)
+    try:
+        single = base.extract_codes(codes)
+        merged = pia_result(merge_partials([analyze_shard(codes, i, 3) for i in [1, 2, 3]]))
+    finally:
+        server.shutdown()
+    assert list(merged.i_frequencies.items()) == list(single.i_frequencies.items())
+    # structure files are named with a unique prefix per run, the structures are compared by their names
+    single_table = interaction_table(single.result, single.complexes)
+    merged_table = interaction_table(merged.result, merged.complexes)
+    assert sorted(zip(*merged_table.values())) == sorted(zip(*single_table.values()))
+    aggregates = lambda result: dict([(key, value) for key, value in result.result.items()
+                                      if key not in [structure_key(result.result, structure) for structure in result.complexes]])
+    assert aggregates(merged) == aggregates(single)
+    single_files = write_result(single, str(tmp_path / "single"))
+    merged_files = write_result(merged, str(tmp_path / "merged"))
+    for single_file, merged_file in zip(single_files, merged_files):
+        if not single_file.endswith(".json"):
+            with open(single_file, "rb") as f, open(merged_file, "rb") as g:
+                assert f.read() == g.read()
+
+# pocket crop, needs PLIP and Open Babel
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+def _plip():
+    pytest.importorskip("plip")
+    from plip.basic.supplemental import int32_to_negative
+    try:
+        int32_to_negative(1)
+    except OverflowError:
+        pytest.skip("PLIP does not work with the installed numpy version")
+
+# write a complex of the example host and every pose of the example SD file, like PIA adds ligands to a host
+def _example_complexes(directory):
+    from openbabel import pybel
+    with open(os.path.join(DATA, "1a28_host.pdb"), "r") as f:
+        host = [line for line in f.read().splitlines() if line.startswith("ATOM") or line.startswith("HETATM")]
+    offset = len(host)
+    complexes = []
+    for i, pose in enumerate(pybel.readfile("sdf", os.path.join(DATA, "1a28_poses.sdf"))):
+        ligand = []
+        for line in pose.write("pdb").splitlines():
+            if line.startswith("ATOM") or line.startswith("HETATM"):
+                ligand.append("HETATM" + str(int(line[6:11]) + offset).rjust(5) + line[11:17] + "LIG Z 999" + line[26:])
+            elif line.startswith("CONECT"):
+                ligand.append("CONECT" + "".join([str(int(line[k:k + 5]) + offset).rjust(5) for k in range(6, len(line.rstrip()), 5)]))
+        complexes.append(os.path.join(str(directory), "complex_" + str(i) + ".pdb"))
+        with open(complexes[-1], "w") as f:
+            f.write("\n".join(host + ligand) + "\nEND\n")
+    return complexes
+
+# all interactions PLIP detects for the docked ligand in a complex, ligands of the host structure are ignored
+def _plip_interactions(complex_file, host_file):
+    from collections import Counter
+    from plip.structure.preparation import PDBComplex
+    with open(host_file, "r") as f:
+        host_residues = set((line[17:20].strip(), line[21], int(line[22:26])) for line in f if line.startswith("HETATM"))
+    mol = PDBComplex()
+    mol.load_pdb(complex_file)
+    mol.analyze()
+    interactions = Counter()
+    for site in mol.interaction_sets.values():
+        if (site.ligand.hetid, site.ligand.chain, site.ligand.position) in host_residues:
+            continue
+        for interaction in site.all_itypes:
+            interactions[type(interaction).__name__ + ":" + str(interaction.restype) + str(interaction.resnr) + str(interaction.reschain)] += 1
+    return interactions
+
+# cropping a complex to the pocket around the ligand gives the same interactions as the whole complex
+def test_crop_complex(tmp_path):
+    _plip()
+    from scripts.spatial import HostIndex, crop_complex
+    host_file = os.path.join(DATA, "1a28_host.pdb")
+    host = HostIndex(host_file)
+    for complex_file in _example_complexes(tmp_path):
+        pocket = complex_file + "_pocket.pdb"
+        assert crop_complex(complex_file, host, pocket)
+        with open(complex_file, "r") as f, open(pocket, "r") as g:
+            assert len(g.readlines()) < len(f.readlines())
+        interactions = _plip_interactions(complex_file, host_file)
+        assert sum(interactions.values()) > 0
+        assert _plip_interactions(pocket, host_file) == interactions
+
+# complexes are cropped in place, complexes without a ligand are left as they are
+def test_crop_complexes(tmp_path):
+    import shutil
+    pytest.importorskip("scipy")
+    pytest.importorskip("openbabel")
+    from scripts.spatial import crop_complexes
+    host_file = os.path.join(DATA, "1a28_host.pdb")
+    complexes = _example_complexes(tmp_path)
+    sizes = [os.path.getsize(f) for f in complexes]
+    shutil.copy(host_file, str(tmp_path / "host_only.pdb"))
+    assert crop_complexes(complexes + [str(tmp_path / "host_only.pdb")], host_file) == 3
+    assert all([os.path.getsize(f) < size for f, size in zip(complexes, sizes)])
+    assert os.path.getsize(str(tmp_path / "host_only.pdb")) == os.path.getsize(host_file)
+    assert sorted(os.listdir(str(tmp_path))) == sorted([os.path.basename(f) for f in complexes] + ["host_only.pdb"])
+
+# prediction with several models extracts interactions once with PIA, the scores have to be the same as the scores
+# of PIA's prediction with each model
+def test_predict_sdf_multi_parity(tmp_path, monkeypatch):
+    import shutil
+    _plip()
+    pytest.importorskip("streamlit")
+    pytest.importorskip("PIA")
+    from PIA.PIAModel import PIAModel
+    from scripts.PIAWebPredict import predict_sdf, predict_sdf_multi
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(os.path.join(DATA, "1a28_host.pdb"), "host.pdb")
+    shutil.copy(os.path.join(DATA, "1a28_poses.sdf"), "poses.sdf")
+    positives = ["Hydrophobic_Interaction:LEU721A", "Hydrophobic_Interaction:PHE778A", "Hydrophobic_Interaction:MET759A",
+                 "Hydrogen_Bond:GLN725A", "Hydrogen_Bond:ARG766A"]
+    PIAModel(positives = positives, strategy = "+", cutoff = 4).save("model")
+    single = predict_sdf("model.piam", "host.pdb", "poses.sdf", tmp_dir_name = "single_structures")["dataframe"]
+    multi = predict_sdf_multi(["model.piam"], "host.pdb", "poses.sdf", model_names = ["model"], tmp_dir_name = "multi_structures")["dataframe"]
+    assert len(multi) == len(single) == 3
+    assert [int(score) for score in multi["model SCORE"]] == [int(score) for score in single["SCORE"]]
+    assert list(multi["model PREDICTION"]) == list(single["PREDICTION"])
+
+# binary models are read with the same fields as their json model
+def test_read_model(tmp_path):
+    pytest.importorskip("streamlit")
+    pytest.importorskip("PIA")
+    import json
+    from scripts.models import encode_model
+    from scripts.PIAWebPredict import read_model
+    with open(str(tmp_path / "model.piam"), "w", encoding = "utf-8") as f:
+        f.write(json.dumps(_MODEL))
+    with open(str(tmp_path / "model.piamb"), "wb") as f:
+        f.write(encode_model(_MODEL))
+    json_model = read_model(str(tmp_path / "model.piam"))
+    binary_model = read_model(str(tmp_path / "model.piamb"))
+    for field in ["positives", "negatives", "strategy", "cutoff", "statistics"]:
+        assert getattr(binary_model, field) == getattr(json_model, field) == _MODEL[field]
+
+# strategy sweep
+
+# every combination of sizes is trained "repeats" times with PIA's options, the test statistics are summarized per
+# strategy and combination of sizes
+def test_sweep(monkeypatch):
+    pytest.importorskip("pandas")
+    import scripts.sweep as sweep_module
+    from scripts.scheduler import Scheduler
+    tasks = []
+    def train_run(task):
+        tasks.append(task)
+        run = task[0]
+        return run, {strategy: {"ACC": run["test_size"] + run["split"], "FPR": 0.0, "AUC": 1.0, "Ya": 1.0, "EF": 2.0, "REF": 100.0, "cutoff": k}
+                     for k, strategy in enumerate(sweep_module.STRATEGIES)}
+    monkeypatch.setattr(sweep_module, "train_run", train_run)
+    result = sweep_module.sweep("host.pdb", "actives.sdf", "inactives.sdf", labels_by = "ic50", test_sizes = [0.2, 0.3], val_sizes = [0.3], repeats = 3, n_jobs = 1)
+    assert len(tasks) == 6 and len(set([prefix for run, files, options, prefix in tasks])) == 6
+    assert tasks[0][1] == ("host.pdb", "actives.sdf", "inactives.sdf") and tasks[0][2]["labels_by"] == "ic50"
+    assert len(result["runs"]) == 24 and list(result["runs"][result["runs"]["strategy"] == "+-"]["cutoff"]) == [2] * 6
+    summary = result["summary"]
+    assert len(summary) == 8 and list(summary["runs"]) == [3] * 8
+    assert list(summary[summary["strategy"] == "+"]["ACC mean"]) == pytest.approx([1.2, 1.3])
+    assert list(summary[summary["strategy"] == "+"]["ACC var"]) == pytest.approx([1.0, 1.0])
+    assert Scheduler(max_concurrent = 1).workers_per_job() == (os.cpu_count() or 1)
+    assert Scheduler(max_concurrent = 10 ** 6).workers_per_job() == 1